@@ -0,0 +1,27 @@
+"""Bit-packed binary masks, used by the packed layout of geojson_to_grid.py
+
+The grid cells of each row are packed 8 per byte (numpy.packbits along longitude).
+"""
+import numpy as np
+
+
+class BitMask:
+    """Binary mask of a (lat, lon) grid, bit-packed along rows
+
+    bits: uint8 array of shape (ni, ceil(nj/8)), as returned by np.packbits(mask, axis=1)
+    nj: number of grid cells along a row
+    """
+    def __init__(self, bits, nj):
+        self.bits = bits
+        self.nj = nj
+
+    @classmethod
+    def from_array(cls, mask):
+        return cls(np.packbits(np.asarray(mask, dtype=bool), axis=1), mask.shape[1])
+
+    @property
+    def shape(self):
+        return self.bits.shape[0], self.nj
+
+    def to_array(self):
+        return np.unpackbits(self.bits, axis=1, count=self.nj).astype(bool)
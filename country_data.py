@@ -1,7 +1,464 @@
 """Get details from World Bank etc
 """
 import os, sys, logging
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import netCDF4 as nc
 
 # countrymasks_folder = os.path.dirname(__file__)
 country_data_folder = os.path.join(sys.prefix, 'country_data')
 countrymasks_folder = country_data_folder
+
+
+def _region_index(ds, code):
+    regions = list(ds['region'][:])
+    try:
+        return regions.index(code)
+    except ValueError:
+        raise KeyError(code)
+
+
+def read_region(ds, code):
+    """Return the mask of a region (e.g. 'FRA') on the full (lat, lon) grid.
+
+    ds: netCDF4.Dataset of country masks, in the default layout (one `m_XXX` variable per region),
+        in the sparse layout written by geojson_to_grid.py --sparse-layout,
+        or in the compact layout written by geojson_to_grid.py --compact-layout
+        (fractions of marginal cells are then quantized, within 7.6e-6 of the original values),
+        or in the bit-packed layout of binary masks written by geojson_to_grid.py --packed-layout
+    """
+    layout = getattr(ds, 'layout', None)
+    if layout == 'compact':
+        return _read_compact_region(ds, code)
+
+    if layout == 'packed':
+        if 'm_'+code not in ds.variables:
+            raise KeyError(code)
+        return np.unpackbits(ds['m_'+code][:], axis=1, count=ds['lon'].size).astype(np.int8)
+
+    if layout != 'sparse':
+        if 'm_'+code not in ds.variables:
+            raise KeyError(code)
+        return ds['m_'+code][:].filled(0)
+
+    k = _region_index(ds, code)
+    start, count = int(ds['region_start'][k]), int(ds['region_count'][k])
+    mask = np.zeros(ds['lat'].size * ds['lon'].size, dtype=ds['cell_value'].dtype)
+    mask[ds['cell_index'][start:start+count]] = ds['cell_value'][start:start+count]
+    return mask.reshape(ds['lat'].size, ds['lon'].size)
+
+
+def _read_compact_region(ds, code):
+    k = _region_index(ds, code)
+    size = ds['lat'].size * ds['lon'].size
+    start, count = int(ds['region_run_start'][k]), int(ds['region_run_count'][k])
+    run_start = ds['run_start'][start:start+count].astype(np.int64)
+    run_end = run_start + ds['run_length'][start:start+count]
+    # runs of ones: +1 at the start and -1 after the end of each run, then cumulative sum
+    edges = np.zeros(size+1, dtype=np.int8)
+    np.add.at(edges, run_start, 1)
+    np.add.at(edges, run_end, -1)
+    mask = np.cumsum(edges[:-1], dtype=np.int8).astype(np.float32)
+    start, count = int(ds['region_margin_start'][k]), int(ds['region_margin_count'][k])
+    mask[ds['margin_index'][start:start+count]] = ds['margin_fraction'][start:start+count]
+    return mask.reshape(ds['lat'].size, ds['lon'].size)
+
+
+def read_label_codes(ds):
+    """Return the ISIPEDIA code of each value of the `labels` variable (geojson_to_grid.py --label-mask),
+    as a list indexed by label ('' for label 0, no country)
+    """
+    return list(ds['label_code'][:])
+
+
+# bounds file of each grid, by number of longitudes (see make_bounds.py)
+BOUNDS_FILES = {
+    720: 'bounds.json',
+    4320: 'bounds_5arcmin.json',
+    43200: 'bounds_30arcsec.json',
+}
+
+
+def read_bounds(code, folder=None, file_name='bounds.json'):
+    """Return the content of country_data/XXX/bounds.json (bounds in degrees, indices on the 0.5 degree grid),
+    or of another bounds file (e.g. bounds_5arcmin.json, indices on the 5 arcmin grid)
+    """
+    with open(os.path.join(folder or country_data_folder, code, file_name)) as f:
+        return json.load(f)
+
+
+def window_slices(bounds, lat, lon):
+    """Return the (lat, lon) slices of the grid cells within bounds (as in bounds.json, in degrees):
+    one pair, or two pairs when the window crosses the antimeridian (`splitted` countries, whose
+    longitudes are in the 0 to 360 range), in the order of the window from its left edge.
+
+    The slices are derived from the grid coordinates, so that they apply to any resolution
+    (the `indices` in bounds.json are those of the 0.5 degree grid).
+    """
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    ii = np.flatnonzero((lat > bounds['bottom']) & (lat < bounds['top']))
+    x = (lon - bounds['left']) % 360  # distance from the left edge
+    jj = np.flatnonzero(x < bounds['right'] - bounds['left'])
+    if ii.size == 0 or jj.size == 0:
+        return []
+    rows = slice(int(ii[0]), int(ii[-1])+1)
+    jj = jj[np.argsort(x[jj])]
+    pieces = np.split(jj, np.flatnonzero(np.diff(jj) != 1) + 1)
+    return [(rows, slice(int(p[0]), int(p[-1])+1)) for p in pieces]
+
+
+def _bounds_file(code, folder, nj):
+    """bounds file of the grid with nj longitudes (see BOUNDS_FILES) if present, bounds.json otherwise"""
+    file_name = BOUNDS_FILES.get(nj, 'bounds.json')
+    if not os.path.exists(os.path.join(folder or country_data_folder, code, file_name)):
+        return 'bounds.json'
+    return file_name
+
+
+def country_window(code, lat, lon, folder=None):
+    """window_slices from country_data/XXX/bounds.json (or the bounds file of the grid, see BOUNDS_FILES),
+    or the whole grid if there is none, or if it leaves out polygons of the country (see window_covers)
+    """
+    file_name = _bounds_file(code, folder, np.size(lon))
+    try:
+        bounds = read_bounds(code, folder, file_name)['bounds']
+    except FileNotFoundError:
+        return [(slice(None), slice(None))]
+    if not window_covers(code, folder, file_name):
+        return [(slice(None), slice(None))]
+    return window_slices(bounds, lat, lon)
+
+
+_geometry_stores = {}
+_window_checks = {}
+
+
+def _polygon_bounds(code, folder):
+    """bounds of each polygon of a country, as an array of (xmin, ymin, xmax, ymax), or None if unknown
+
+    From the geometry store of countrymasks.geojson next to the folder if there is one (see
+    geomstore.GeometryStore), from XXX/country.geojson otherwise.
+    """
+    import shapely
+    import shapely.geometry
+    geojson = os.path.join(os.path.dirname(os.path.abspath(folder)), 'countrymasks.geojson')
+    if os.path.exists(geojson):
+        from geomstore import GeometryStore
+        if geojson not in _geometry_stores:
+            _geometry_stores[geojson] = GeometryStore.load(geojson)
+        store = _geometry_stores[geojson]
+        if code in store:
+            return shapely.bounds(shapely.get_parts(store.geometry(code)))
+    try:
+        with open(os.path.join(folder, code, 'country.geojson')) as f:
+            geom = shapely.geometry.shape(json.load(f)['geometry'])
+    except FileNotFoundError:
+        return None
+    return shapely.bounds(shapely.get_parts(geom))
+
+
+def _window_covers(code, folder, file_name):
+    try:
+        bounds = read_bounds(code, folder, file_name)['bounds']
+    except FileNotFoundError:
+        return False
+    parts = _polygon_bounds(code, folder)
+    if parts is None:
+        return True  # nothing to check against
+    width = bounds['right'] - bounds['left']
+    for xmin, ymin, xmax, ymax in parts:
+        x = (xmin - bounds['left']) % 360  # position of the polygon within the window
+        if x > 360 - 1e-9:
+            x -= 360
+        if x < 0 or x + (xmax - xmin) > width or ymin < bounds['bottom'] or ymax > bounds['top']:
+            logging.warning(f"{code}: {file_name} leaves out polygons of the country, the whole grid is read instead (see make_bounds.py)")
+            return False
+    return True
+
+
+def window_covers(code, folder=None, file_name='bounds.json'):
+    """Return True if the window of country_data/XXX/bounds.json (or file_name) contains every polygon
+    of the country, so that a window read leaves out no grid cell of it (False without the bounds file,
+    True if the polygons are unknown). Checked once per code (see _polygon_bounds).
+
+    country_window falls back to the whole grid otherwise.
+    """
+    folder = folder or country_data_folder
+    key = os.path.abspath(folder), code, file_name
+    if key not in _window_checks:
+        _window_checks[key] = _window_covers(code, folder, file_name)
+    return _window_checks[key]
+
+
+def read_window(v, code, folder=None):
+    """Read the (lat, lon) netCDF variable v (e.g. `m_FRA` or `cell_area`) only within the window
+    of a country (see country_window), with the longitude pieces side by side
+    """
+    ds = v.group()
+    lat, lon = ds[v.dimensions[0]][:], ds[v.dimensions[1]][:]
+    pieces = [v[rows, cols] for rows, cols in country_window(code, lat, lon, folder)]
+    if not pieces:
+        return np.ma.zeros((0, 0), dtype=v.dtype)
+    return np.ma.concatenate(pieces, axis=1)
+
+
+class CountryMasks:
+    """Country masks of a netCDF file, opened once, loaded lazily and kept in a least-recently-used cache
+
+        masks = CountryMasks()  # countrymasks.nc installed in country_data_folder
+        masks['FRA']  # (lat, lon) mask of France
+        masks.get_many(['FRA', 'DEU'])  # {'FRA': ..., 'DEU': ...}
+
+    path: netCDF file of country masks (any layout supported by read_region)
+    crop: if True, masks are cropped to the window of bounds.json (see coords for the
+        corresponding lat and lon, and window_slices for countries across the antimeridian)
+    max_memory: size of the cache in bytes, beyond which the least recently used masks are dropped
+    folder: where to find XXX/bounds.json (default: country_data_folder)
+
+    The returned arrays are shared with the cache, and read-only.
+    """
+    def __init__(self, path=None, crop=False, max_memory=500e6, folder=None):
+        self.path = path or os.path.join(country_data_folder, 'countrymasks.nc')
+        self.crop = crop
+        self.max_memory = max_memory
+        self.folder = folder
+        self.ds = nc.Dataset(self.path)
+        self.lat, self.lon = self.ds['lat'][:], self.ds['lon'][:]
+        self._codes = set(self.codes)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # netCDF4 is not thread-safe
+
+    @property
+    def codes(self):
+        if getattr(self.ds, 'layout', None) in ('sparse', 'compact'):
+            return list(self.ds['region'][:])
+        return [m[2:] for m in self.ds.variables if m.startswith('m_')]
+
+    def window(self, code):
+        """[(lat, lon), ...] slices of the country window (see country_window)"""
+        return country_window(code, self.lat, self.lon, self.folder)
+
+    def coords(self, code):
+        """(lat, lon) coordinates of masks[code]"""
+        if not self.crop:
+            return self.lat, self.lon
+        pieces = self.window(code)
+        return self.lat[pieces[0][0]], np.concatenate([self.lon[cols] for _, cols in pieces])
+
+    def _read(self, code):
+        if not self.crop:
+            return read_region(self.ds, code)
+        if getattr(self.ds, 'layout', None) is None:
+            return read_window(self.ds['m_'+code], code, self.folder).filled(0)
+        mask = read_region(self.ds, code)
+        return np.concatenate([mask[rows, cols] for rows, cols in self.window(code)], axis=1)
+
+    def __getitem__(self, code):
+        if code not in self._codes:
+            raise KeyError(code)
+        with self._lock:
+            if code in self._cache:
+                self._cache.move_to_end(code)
+                return self._cache[code]
+            mask = self._read(code)
+            mask.flags.writeable = False
+            self._cache[code] = mask
+            size = sum(m.nbytes for m in self._cache.values())
+            while size > self.max_memory and len(self._cache) > 1:
+                _, dropped = self._cache.popitem(last=False)
+                size -= dropped.nbytes
+            return mask
+
+    def get_many(self, codes):
+        """Return {code: mask} for several countries"""
+        return {code: self[code] for code in codes}
+
+    def __contains__(self, code):
+        return code in self._codes
+
+    def close(self):
+        self._cache.clear()
+        self.ds.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _label_cache_files(path, cache_folder=None):
+    """Return the .npy files of the label raster and of the bit-packed border cells of a mask file
+    """
+    if cache_folder is None:
+        cache_folder = os.path.dirname(os.path.abspath(path))
+        if not os.access(cache_folder, os.W_OK):
+            cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'isipedia-countries')
+    os.makedirs(cache_folder, exist_ok=True)
+    base = os.path.join(cache_folder, os.path.splitext(os.path.basename(path))[0])
+    return base+'.labels.npy', base+'.border.npy'
+
+
+def _border_cells(labels, above, below):
+    """True where any of the 8 neighbouring grid cells has another label (longitudes wrap around)
+
+    above, below: the rows next to the band of labels (or copies of its first and last rows)
+    """
+    ext = np.concatenate([above, labels, below])
+    border = np.zeros(labels.shape, dtype=bool)
+    for di in range(3):
+        rows = ext[di:di+labels.shape[0]]
+        for dj in (-1, 0, 1):
+            border |= np.roll(rows, dj, axis=1) != labels
+    return border
+
+
+def _write_npy(path, shape, dtype, fill):
+    """Write a .npy file through a temporary file, with fill(array) filling the memory-mapped array
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+    os.close(fd)
+    array = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+    fill(array)
+    array.flush()
+    del array
+    os.replace(tmp, path)
+
+
+def _build_label_cache(ds, labels_file, border_file):
+    v = ds['labels']
+    ni, nj = v.shape
+    step = max(1, 2**26 // nj)  # rows per band
+
+    def fill_labels(labels):
+        for k in range(0, ni, step):
+            labels[k:k+step] = v[k:k+step].filled(0)
+
+    _write_npy(labels_file, (ni, nj), v.dtype, fill_labels)
+    labels = np.load(labels_file, mmap_mode='r')
+
+    def fill_border(border):
+        for k in range(0, ni, step):
+            band = labels[k:k+step]
+            above = labels[k-1:k] if k > 0 else band[:1]
+            below = labels[k+step:k+step+1] if k+step < ni else band[-1:]
+            border[k:k+step] = np.packbits(_border_cells(band, above, below), axis=1)
+
+    _write_npy(border_file, (ni, (nj+7)//8), np.uint8, fill_border)
+
+
+class PointLookup:
+    """Country of points, from the label raster of exclusive masks (geojson_to_grid.py --label-mask)
+
+        lookup = PointLookup('countrymasks_binary_exclusive_5arcmin.nc')
+        lookup(lon, lat)  # array of ISIPEDIA codes ('' outside any country)
+
+    path: netCDF file with the `labels` and `label_code` variables, e.g. written by
+        geojson_to_grid.py --binary-exclusive-mask --force-exclusivity --label-mask (see job.sh;
+        the installed masks were written without a label raster)
+    cache_folder: where to keep the label raster as .npy files, memory-mapped
+        (default: next to path if writable, else ~/.cache/isipedia-countries)
+    folder: where to find XXX/country.geojson for the exact test (default: country_data_folder)
+
+    Points are mapped to grid cells arithmetically, with the same transform as
+    geomtools.coords_to_gdal_transform. With exact=True, points in border cells (next to a
+    grid cell of another label, or of no country) are tested against the country polygons,
+    with precedence in alphabetical order as for the exclusive masks. Features smaller than a
+    grid cell and away from any other label (tiny islands) are only found on finer grids.
+    """
+    def __init__(self, path, cache_folder=None, folder=None):
+        self.path = path
+        self.folder = folder
+        labels_file, border_file = _label_cache_files(self.path, cache_folder)
+        with nc.Dataset(self.path) as ds:
+            if 'labels' not in ds.variables:
+                raise ValueError(f"{self.path} has no label raster: use geojson_to_grid.py --label-mask")
+            self.codes = np.array(read_label_codes(ds))
+            lon, lat = ds['lon'][:], ds['lat'][:]
+            if not all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(self.path)
+                       for f in (labels_file, border_file)):
+                logging.info(f"write the label raster of {self.path} to {labels_file}")
+                _build_label_cache(ds, labels_file, border_file)
+        self.labels = np.load(labels_file, mmap_mode='r')
+        self.border = np.load(border_file, mmap_mode='r')
+        self.dx, self.dy = float(lon[1] - lon[0]), float(lat[1] - lat[0])
+        self.x0, self.y0 = float(lon[0]) - self.dx/2, float(lat[0]) - self.dy/2
+        self._tree = None
+
+    def cells(self, lon, lat):
+        """Return the (i, j) grid indices of the points, and whether they are on the grid
+        """
+        ni, nj = self.labels.shape
+        i = np.floor((lat - self.y0) / self.dy)
+        j = np.floor((lon - self.x0) / self.dx)
+        # i == ni only on the last grid edge (e.g. lat == -90), not below
+        valid = (i >= 0) & ((i < ni) | (i == ni) & np.isclose(lat, self.y0 + ni*self.dy)) & np.isfinite(j)
+        i = np.where(valid, np.minimum(i, ni-1), 0).astype(np.intp)
+        j = np.where(valid, j, 0).astype(np.intp) % nj
+        return i, j, valid
+
+    def _geometries(self):
+        if self._tree is None:
+            import shapely
+            import shapely.geometry as shg
+            geoms, labels = [], []
+            for k, code in enumerate(self.codes[1:], 1):
+                try:
+                    with open(os.path.join(self.folder or country_data_folder, code, 'country.geojson')) as f:
+                        geoms.append(shg.shape(json.load(f)['geometry']))
+                except FileNotFoundError:
+                    logging.warning(f"{code}: no country.geojson, its border points are left to the label raster")
+                    continue
+                labels.append(k)
+            has_geometry = np.zeros(len(self.codes), dtype=bool)
+            has_geometry[labels] = True
+            self._tree = shapely.STRtree(geoms), np.array(labels, dtype=self.labels.dtype), has_geometry
+        return self._tree
+
+    def exact(self, lon, lat):
+        """Return the labels of points from the country polygons (0 outside any country),
+        for longitudes in the -180 to 180 range of the polygons
+        """
+        import shapely
+        tree, labels, _ = self._geometries()
+        point, geom = tree.query(shapely.points(lon, lat), predicate='intersects')
+        result = np.zeros(np.size(lon), dtype=self.labels.dtype)
+        # several matches on borders: the lowest label wins
+        order = np.lexsort((labels[geom], point))
+        point, first = np.unique(point[order], return_index=True)
+        result[point] = labels[geom[order][first]]
+        return result
+
+    def __call__(self, lon, lat, exact=True):
+        """Return the ISIPEDIA codes of points (numpy arrays of longitudes and latitudes in degrees)
+        """
+        lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        i, j, valid = self.cells(lon, lat)
+        labels = np.where(valid, self.labels[i, j], 0)
+        if exact:
+            border = (self.border[i, j >> 3] >> (7 - (j & 7)).astype(np.uint8)) & 1
+            k = np.flatnonzero(border.astype(bool) & valid)
+            if k.size > 0:
+                exact = self.exact((lon.flat[k] + 180) % 360 - 180, lat.flat[k])
+                # outside any polygon: only trusted if the raster label has a polygon to test against
+                raster = labels.flat[k]
+                labels.flat[k] = np.where((exact > 0) | self._geometries()[2][raster], exact, raster)
+        return self.codes[labels]
+
+
+_point_lookups = {}
+
+
+def lookup(lon, lat, path, exact=True):
+    """Return the ISIPEDIA code of each point, '' outside any country (see PointLookup)
+
+    path: netCDF file with a label raster (see PointLookup)
+
+    The label raster of path is loaded once and kept for later calls.
+    """
+    if path not in _point_lookups:
+        _point_lookups[path] = PointLookup(path)
+    return _point_lookups[path](lon, lat, exact=exact)
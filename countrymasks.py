@@ -1,6 +1,7 @@
 import json , os
 import netCDF4 as nc
 import shortcountrynames
+from country_data import read_window
 
 def getarea(code, mask=None, grid=None):
     geopath = os.path.join('country_data', code, 'country.geojson')
@@ -15,8 +16,10 @@ def areafrommask(code, mask=None, grid=None):
         mask = nc.Dataset('countrymasks_fractional.nc')
     if grid is None:
         grid = nc.Dataset('../datasets/gridarea.nc')
-    m = mask['m_'+code][:]
-    return (grid['cell_area'][:][m>0]*m[m>0]).sum()*1e-6  # in km2
+    # only read the window of the country (see country_data/XXX/bounds.json), or the whole grid if it misses polygons
+    m = read_window(mask['m_'+code], code, 'country_data')
+    cell_area = read_window(grid['cell_area'], code, 'country_data')
+    return (cell_area[m>0]*m[m>0]).sum()*1e-6  # in km2
 
 
 def countrymetadata():
@@ -1,14 +1,24 @@
 #!venv/bin/python
+import os
 import sys
 sys.path.insert(0, '.')
+import time
 import tqdm
 import argparse
 import numpy as np
 # import xarray as xa
 import netCDF4 as nc
-import json
-import shapely.geometry as shg
-from geomtools import polygon_to_mask, polygon_to_fractional_mask
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import shapely
+import shapely.wkb
+import re
+from scipy.ndimage import find_objects
+from maskcache import MaskCache
+from bitmask import BitMask
+from geomstore import GeometryStore
+from geomtools import polygon_to_mask, polygon_to_fractional_mask, fractional_mask_error, polygons_to_labels, block_reduce
+from geomtools import grid_window, fractional_mask_band, encode_fractional_mask, decode_fractional_mask
 
 REPOSITORY = 'https://github.com/ISI-MIP/isipedia-countries'
 
@@ -38,15 +48,39 @@ grouping = {
 
 group_codes = [g['ISIPEDIA'] for g in grouping['groups']]
 
+RESOLUTIONS = {
+    "0.5deg": 0.5,
+    "5arcmin": 5/60,
+    "30arcsec": 30/3600,
+}
 
-def init_dataset(file_name, js, res, version=None):
-    version = version or js['properties']['version']
-    source = js['properties']['source']
+# default chunk shape (lat, lon) of the mask variables, sized for reading one country window
+DEFAULT_CHUNKSIZES = {
+    "0.5deg": (120, 120),  # 60 degrees
+    "5arcmin": (240, 240),  # 20 degrees
+    "30arcsec": (600, 600),  # 5 degrees
+}
 
+
+def grid_coords(res):
     lon = np.arange(-180+res/2, 180, res)
     lat = np.arange(90-res/2, -90, -res)  # upside down...
+    return lon, lat
+
+
+def init_dataset(file_name, js, res, version=None, resume=False):
+    version = version or js['properties']['version']
+    source = js['properties']['source']
+
+    lon, lat = grid_coords(res)
     ni, nj = lat.size, lon.size
 
+    if resume and os.path.exists(file_name):
+        ds = nc.Dataset(file_name, 'a')
+        if ds['lat'].size != ni or ds['lon'].size != nj:
+            raise ValueError(f"{file_name}: cannot resume, grid differs from {res} degrees resolution")
+        return ds
+
     ds = nc.Dataset(file_name,'w', zlib=True)
 
     ds.source = source
@@ -67,110 +101,718 @@ def init_dataset(file_name, js, res, version=None):
     return ds
 
 
-def make_exclusive(ds):
-    # Add world mask from existing countries
-    print("Force exclusivity of pixels")
-    shp = ds['lat'].size, ds["lon"].size
-    sum_mask = np.zeros(shp, dtype=int)
-    collect = {}
-    for m in ds.variables:
-        if not is_country(m):
+def _create_mask_variable(ds, name, datatype, **encoding):
+    """create a (lat, lon) mask variable
+
+    encoding: chunking and compression keyword arguments passed to createVariable
+        (chunksizes, zlib, complevel, shuffle, least_significant_digit)
+
+    The chunks never written (see _write_window) are not stored, and read as 0: the variable is
+    created with a fill value of 0, which HDF5 keeps for unwritten chunks, and the _FillValue attribute
+    is then removed, so that zeros are not masked on reading (netCDF4, xarray) and integer masks stay integers.
+    (With fill_value=False, HDF5 never fills, and unwritten chunks would read as uninitialized memory.)
+    """
+    kwargs = dict(zlib=True, fill_value=0)
+    kwargs.update(encoding)
+    if kwargs.get('chunksizes'):
+        # no larger than the grid (e.g. --chunk-size for the coarser grids of --pyramid)
+        kwargs['chunksizes'] = tuple(min(n, len(ds.dimensions[dim])) for n, dim in zip(kwargs['chunksizes'], ('lat', 'lon')))
+    v = ds.createVariable(name, datatype, ('lat', 'lon'), **kwargs)
+    v.delncattr('_FillValue')
+    return v
+
+
+def _band_step(v):
+    """number of rows of the chunk bands of a (lat, lon) variable"""
+    chunking = v.chunking()
+    return v.shape[0] if chunking == 'contiguous' else chunking[0]
+
+
+def _chunk_aligned(v, axis, a, b):
+    """extend the range a:b along axis of the variable v to whole chunks"""
+    chunking = v.chunking()
+    if chunking == 'contiguous':
+        return a, b
+    n = chunking[axis]
+    return a // n * n, min(-(-b // n) * n, v.shape[axis])
+
+
+def _write_window(v, mask, i0, j0):
+    """write mask at offset (i0, j0) in the new (lat, lon) variable v (zero elsewhere, see _create_mask_variable)
+
+    Only the window extended to whole chunks is written, so that the cost does not depend on the
+    size of the grid, and every chunk is written exactly once.
+    """
+    a, b = _chunk_aligned(v, 0, i0, i0+mask.shape[0])
+    c, d = _chunk_aligned(v, 1, j0, j0+mask.shape[1])
+    window = np.zeros((b-a, d-c), dtype=mask.dtype)
+    window[i0-a:i0-a+mask.shape[0], j0-c:j0-c+mask.shape[1]] = mask
+    v[a:b, c:d] = window
+
+
+def _write_bands(v, bands):
+    """write the bands [(i0, j0, mask), ...] of a mask in the new (lat, lon) variable v (zero elsewhere)
+
+    Like _write_window, only whole chunks are written: for each band of chunk rows, the chunk
+    columns that cover the bands within. The bands must be sorted by row and must not overlap.
+    """
+    ni, nj = v.shape
+    step = _band_step(v)
+    bands = iter(bands)
+    pending = next(bands, None)
+    for k in range(0, ni, step):
+        if pending is None:
+            break
+        height = min(step, ni-k)
+        pieces = []
+        while pending is not None and pending[0] < k+height:
+            i0, j0, mask = pending
+            a, b = max(i0, k), min(i0+mask.shape[0], k+height)
+            pieces.append((a-k, j0, mask[a-i0:b-i0]))
+            if b < i0+mask.shape[0]:
+                break  # continued in the next chunk band
+            pending = next(bands, None)
+        if not pieces:
             continue
-        mask = ds[m][:].filled(0) > 0
-        already_occupied = sum_mask[mask] > 0
-        n = already_occupied.sum()
-        if n > 0:
-            print(f"{m[2:]}: {n} grid cells already taken by another country, mask out ! (out of {mask.sum()} ~ {n/mask.sum()*100:.2f} %)")
+        c, d = _chunk_aligned(v, 1, min(j0 for _, j0, _ in pieces), max(j0+m.shape[1] for _, j0, m in pieces))
+        band = np.zeros((height, d-c), dtype=v.dtype)
+        for i, j0, mask in pieces:
+            band[i:i+mask.shape[0], j0-c:j0-c+mask.shape[1]] = mask
+        v[k:k+height, c:d] = band
+
+
+def _mask_encoding(v):
+    """return the encoding of an existing mask variable, to create new variables alike
+    """
+    filters = v.filters() or {}
+    encoding = {k: filters[k] for k in ['zlib', 'complevel', 'shuffle'] if k in filters}
+    chunking = v.chunking()
+    if chunking != 'contiguous':
+        encoding['chunksizes'] = tuple(chunking)
+    if 'least_significant_digit' in v.ncattrs():
+        encoding['least_significant_digit'] = v.least_significant_digit
+    return encoding
+
+
+def _completed_variables(ds):
+    """return the names of the variables with a completion marker (see --resume)
+    """
+    return {m for m in ds.variables if getattr(ds[m], 'complete', 0)}
 
-            i, j = np.where(mask & (sum_mask > 0))
-            for ii, jj in zip(i, j):
-                ds[m][ii,jj] = 0
-            mask = ds[m][:].filled(0) > 0
 
-        sum_mask[mask] += 1
+def _log_timing(file_name, code, seconds):
+    # per-country timing log, appended to so that it survives resumed runs
+    with open(file_name.replace('.nc', '.timing.log'), 'a') as f:
+        f.write(f"{code} {seconds:.3f}\n")
 
-    assert sum_mask.max() == 1, repr(sum_mask.max())
+
+def _first_country_variable(ds):
+    return ds[next(m for m in ds.variables if is_country(m))]
+
+
+def make_exclusive(ds):
+    """Remove from each country the grid cells already taken by a previous country (alphabetical order)
+
+    The grid cells to remove are found in the shared cells table (see shared_cells), and
+    countries are only read and written back within the window of their removed grid cells.
+    """
+    print("Force exclusivity of pixels")
+    nj = ds["lon"].size
+    countries = _country_variables(ds)
+    step = _band_step(_first_country_variable(ds))
+    cells, labels, _ = shared_cells(ds)
+    # sorted by cell then label: the first country of each cell keeps it
+    lost = np.concatenate([[False], cells[1:] == cells[:-1]])
+    for k in np.unique(labels[lost]):
+        m = countries[k-1]
+        ii, jj = np.divmod(cells[lost & (labels == k)], nj)
+        n = ii.size
+        total = sum(int((ds[m][i:i+step].filled(0) > 0).sum()) for i in range(0, ds['lat'].size, step))
+        print(f"{m[2:]}: {n} grid cells already taken by another country, mask out ! (out of {total} ~ {n/total*100:.2f} %)")
+
+        # write back once, only the window that contains the removed grid cells
+        window = np.s_[ii.min():ii.max()+1, jj.min():jj.max()+1]
+        mask = ds[m][window].filled(0)
+        mask[ii-ii.min(), jj-jj.min()] = 0
+        ds[m][window] = mask
+
+    _write_shared_cells(ds, [], [], [])  # no grid cell is shared any more
+
+
+def make_exclusive_by_fraction(ds, fractional):
+    """Make the binary masks in ds exclusive, by giving each grid cell claimed by several countries
+    to the country with the largest fraction in the fractional masks of the same grid (and to the first
+    in alphabetical order in case of equality). The label mask is added at the same time.
+
+    The contested grid cells are taken from the shared cells table (see shared_cells), fractions are
+    only read within the window of the contested grid cells of each country, and the winners are found
+    with one lexsort over them. Countries are only written back within the window of the grid cells they lost,
+    and the label mask is then written country by country within their window (see label_windows).
+    """
+    print("Force exclusivity of pixels (largest fraction)")
+    countries = _country_variables(ds)
+    missing = [m[2:] for m in countries if m not in fractional.variables]
+    if missing:
+        raise ValueError(f"{fractional.filepath()}: no fractional mask for {', '.join(missing)}")
+    ni, nj = ds['lat'].size, ds["lon"].size
+    if fractional['lat'].size != ni or fractional['lon'].size != nj:
+        raise ValueError(f"{fractional.filepath()}: grid differs from {ds.filepath()}")
+
+    cells, ks, _ = shared_cells(ds)
+    fractions = np.zeros(cells.size, dtype=np.float32)
+    for k in np.unique(ks):
+        claimed = ks == k
+        ii, jj = np.divmod(cells[claimed], nj)
+        fraction = fractional[countries[k-1]][ii.min():ii.max()+1, jj.min():jj.max()+1].filled(0)
+        fractions[claimed] = fraction[ii-ii.min(), jj-jj.min()]
+
+    # sort by cell, then largest fraction, then alphabetical order: the first of each cell wins
+    order = np.lexsort((ks, -fractions, cells))
+    cells, ks = cells[order], ks[order]
+    lost = np.concatenate([[False], cells[1:] == cells[:-1]])
+
+    for k in np.unique(ks[lost]):
+        m = countries[k-1]
+        ii, jj = np.divmod(cells[lost & (ks == k)], nj)
+        print(f"{m[2:]}: {ii.size} contested grid cells given to a country with a larger fraction")
+        window = np.s_[ii.min():ii.max()+1, jj.min():jj.max()+1]
+        mask = ds[m][window].filled(0)
+        mask[ii-ii.min(), jj-jj.min()] = 0
+        ds[m][window] = mask
+
+    _write_shared_cells(ds, [], [], [])  # no grid cell is shared any more
+    _add_exclusive_label_mask(ds)
+
+
+def _force_exclusivity(ds, o, fractional_file=None):
+    if o.exclusivity == 'fraction':
+        with nc.Dataset(fractional_file or o.fractional_file) as fractional:
+            make_exclusive_by_fraction(ds, fractional)
+    else:
+        make_exclusive(ds)
+
+
+def pairwise_overlaps(ds):
+    """return {(a, b): n}, the number of grid cells shared by each pair of overlapping countries
+
+    Calculated from the shared cells table (see shared_cells).
+    """
+    codes = [m[2:] for m in _country_variables(ds)]
+    cells, labels, _ = shared_cells(ds)
+    overlaps = {}
+    # rows are sorted by cell then label: pair each row with the next d-th row of the same cell
+    for d in range(1, cells.size):
+        same = cells[d:] == cells[:-d]
+        if not same.any():
+            break
+        pairs, counts = np.unique(np.stack([labels[:-d][same], labels[d:][same]]), axis=1, return_counts=True)
+        for (a, b), n in zip(pairs.T, counts):
+            key = codes[a-1], codes[b-1]
+            overlaps[key] = overlaps.get(key, 0) + int(n)
+    return overlaps
+
+
+def report_overlaps(ds):
+    print("Pairwise overlaps between countries")
+    overlaps = pairwise_overlaps(ds)
+    for (a, b), n in sorted(overlaps.items(), key=lambda item: -item[1]):
+        print(f"    - {a} {b}: {n} grid cells in common")
+    print(len(overlaps), "pairs of countries overlap")
+
+
+def _label_dtype(n):
+    # smallest unsigned type for labels 0 to n (and the default fill value above)
+    return np.uint8 if n < 255 else np.uint16
+
+
+def _country_windows(ds):
+    """yield (k, window, mask) for each country with grid cells: its label, its window (see label_windows)
+    and the boolean mask within
+    """
+    windows = label_windows(ds)
+    for k, m in enumerate(tqdm.tqdm(_country_variables(ds)), 1):
+        i0, i1, j0, j1 = windows[k]
+        if i1 > i0:
+            window = np.s_[i0:i1, j0:j1]
+            yield k, window, ds[m][window].filled(0) > 0
 
 
 def exclusive_country_masks_as_one_labelled_array(ds):
+    """return (label_mask, label_codes), where label k (1 to N) marks the grid cells of the
+    country label_codes[k-1], and 0 the grid cells without country
 
+    Labels are dense and follow the order of the country variables (alphabetical).
+    Countries are only read within their window (see label_windows).
+    """
     shp = ds['lat'].size, ds["lon"].size
-    label_mask = np.zeros(shp, dtype=int)
-    label_names = {}
-    collect = {}
-    for i, m in enumerate(tqdm.tqdm(ds.variables)):
-        if not is_country(m):
-            continue
-        mask = ds[m][:].filled(0) > 0
-        label_mask[mask] = i
-        label_names[i] = m[2:]
+    countries = _country_variables(ds)
+    label_mask = np.zeros(shp, dtype=_label_dtype(len(countries)))
+    for k, window, mask in _country_windows(ds):
+        label_mask[window][mask] = k
+
+    return label_mask, [m[2:] for m in countries]
 
-    return label_mask, label_names
 
+def _add_exclusive_label_mask(ds, label_mask=None, label_codes=None):
+    """Add the `labels` variable, and the `label_code` variable along the `label` dimension,
+    such that label_code[k] is the ISIPEDIA code of label k ('' for 0).
 
-def _add_exclusive_label_mask(ds):
+    Without label_mask, the labels are written country by country within their window (see
+    label_windows), so that neither the countries nor the label raster are read as a whole.
+
+    See country_data.read_label_codes
+    """
+    if label_mask is None:
+        label_codes = [m[2:] for m in _country_variables(ds)]
+    variable = _first_country_variable(ds)
     try:
-        label = ds.createVariable('labels', int, ("lat", "lon"), zlib=True)
+        label = _create_mask_variable(ds, 'labels', _label_dtype(len(label_codes)), **_mask_encoding(variable))
     except RuntimeError:
         label = ds['labels']
+        if label_mask is None:
+            step = _band_step(label)
+            for i in range(0, label.shape[0], step):
+                label[i:i+step] = 0  # labels of a previous run
+    if label_mask is None:
+        for k, window, mask in _country_windows(ds):
+            labels = label[window].filled(0)
+            labels[mask] = k
+            label[window] = labels
+    else:
+        label[:] = label_mask
+    label.long_name = 'country label, 0 where no country (see label_code)'
+    _add_label_codes(ds, label_codes)
 
-    label_mask, label_names = exclusive_country_masks_as_one_labelled_array(ds)
-    ds["labels"][:] = label_mask
-    ds["labels"].label_mapping = label_names
+
+def _add_label_codes(ds, label_codes):
+    if 'label' not in ds.dimensions:
+        ds.createDimension('label', len(label_codes)+1)
+    try:
+        code = ds.createVariable('label_code', str, 'label')
+    except RuntimeError:
+        code = ds['label_code']
+    code[:] = np.array([''] + list(label_codes), dtype=object)
+    code.long_name = 'ISIPEDIA code of each label'
+
+
+def _country_variables(ds):
+    return [m for m in ds.variables if is_country(m)]
+
+
+def _shared_in_band(claims, size, offset=0):
+    """return (cells, labels, values) of the grid cells claimed by more than one country in a band
+
+    claims: {label: (index, values)}, with the flat indices of the non-zero grid cells of each country in the band
+    size: number of grid cells in the band
+    offset: flat index of the first grid cell of the band
+    """
+    count = np.zeros(size, dtype=np.uint8)
+    for index, _ in claims.values():
+        count[index] += 1
+    cells, labels, values = [], [], []
+    for k, (index, v) in claims.items():
+        shared = count[index] > 1
+        cells.append(index[shared] + offset)
+        labels.append(np.full(shared.sum(), k))
+        values.append(v[shared])
+    return cells, labels, values
+
+
+def _windows_in_band(windows, claims, offset, nj):
+    """extend the windows {label: [i0, i1, j0, j1]} to the non-zero grid cells of each country in a band
+    (see _shared_in_band), the bands being processed in order
+    """
+    for k, (index, _) in claims.items():
+        ii, jj = np.divmod(index + offset, nj)
+        window = windows.setdefault(k, [ii[0], 0, nj, 0])
+        window[1] = ii[-1] + 1
+        window[2] = min(window[2], jj.min())
+        window[3] = max(window[3], jj.max() + 1)
+
+
+def _write_label_windows(ds, windows):
+    """persist the windows {label: [i0, i1, j0, j1]} of the countries in ds (see label_windows)
+    """
+    codes = [m[2:] for m in _country_variables(ds)]
+    _add_label_codes(ds, codes)
+    if 'window' not in ds.dimensions:
+        ds.createDimension('window', 4)
+    try:
+        v = ds.createVariable('label_window', 'i4', ('label', 'window'))
+    except RuntimeError:
+        v = ds['label_window']
+    data = np.zeros((len(codes)+1, 4), dtype=np.int32)
+    for k, window in windows.items():
+        data[k] = window
+    v[:] = data
+    v.long_name = 'grid rows i0:i1 and columns j0:j1 (i0, i1, j0, j1) that contain the grid cells of each label (see label_code)'
+
+
+def label_windows(ds):
+    """return the window (i0, i1, j0, j1) of each label (see label_code) as an array of shape (labels, 4),
+    such that the grid cells of country k are within rows i0:i1 and columns j0:j1 (empty for label 0
+    and countries without grid cells).
+
+    Like the shared cells table, the windows are written by the world mask stages (the stages that only
+    remove grid cells afterwards leave them valid), and built with one pass over the masks if missing.
+    """
+    if 'label_window' not in ds.variables:
+        _scan_countries(ds)
+    return ds['label_window'][:].filled(0).astype(np.int64)
+
+
+def _write_shared_cells(ds, cells, labels, values):
+    """persist the shared cells table in ds (see shared_cells), sorted by cell then label
+    """
+    codes = [m[2:] for m in _country_variables(ds)]
+    _add_label_codes(ds, codes)
+    cells = np.concatenate([np.zeros(0, dtype=np.int64)] + list(cells))
+    labels = np.concatenate([np.zeros(0, dtype=int)] + list(labels))
+    values = np.concatenate([np.zeros(0, dtype=_first_country_variable(ds).dtype)] + list(values))
+    order = np.lexsort((labels, cells))
+    if 'shared' not in ds.dimensions:
+        ds.createDimension('shared', None)
+    for name, datatype, data, long_name in [
+            ('shared_cell', 'i4', cells, 'flat index of a grid cell claimed by more than one country'),
+            ('shared_label', _label_dtype(len(codes)), labels, 'label of one of the countries (see label_code)'),
+            ('shared_value', _first_country_variable(ds).datatype, values, 'mask value of that country')]:
+        try:
+            v = ds.createVariable(name, datatype, 'shared', zlib=True)
+        except RuntimeError:
+            v = ds[name]
+        v[:cells.size] = data[order]
+        if v.shape[0] > cells.size:
+            v[cells.size:] = np.ma.masked  # left from a previous, longer table
+        v.long_name = long_name
+    ds.shared_cells = cells.size
+
+
+def shared_cells(ds):
+    """return the table of the grid cells claimed by more than one country, as (cells, labels, values)
+    sorted by cell then label: flat grid cell index (lat, lon order), label of the country (see
+    label_code) and its mask value.
+
+    The table is written by the world mask stages, which read all masks anyway, and kept up to date
+    by the stages that modify the masks afterwards, so that cross-country operations (exclusivity,
+    overlap statistics) only go through the shared grid cells. It is built with one pass over the
+    masks if missing.
+    """
+    if 'shared_cells' not in ds.ncattrs():
+        _scan_countries(ds)
+    n = ds.shared_cells
+    return ds['shared_cell'][:n].filled(0).astype(np.int64), ds['shared_label'][:n].filled(0).astype(int), ds['shared_value'][:n].filled(0)
+
+
+def _scan_countries(ds):
+    """build the shared cells table and the windows of the countries with one pass over the masks
+    """
+    print("Build the table of shared grid cells")
+    ni, nj = ds['lat'].size, ds["lon"].size
+    step = _band_step(_first_country_variable(ds))
+    table = [], [], []
+    windows = {}
+    for k0 in range(0, ni, step):
+        claims = {}
+        for k, m in enumerate(_country_variables(ds), 1):
+            mask = ds[m][k0:k0+step].filled(0).ravel()
+            index = np.flatnonzero(mask)
+            if index.size > 0:
+                claims[k] = index, mask[index]
+        for t, part in zip(table, _shared_in_band(claims, min(step, ni-k0)*nj, k0*nj)):
+            t.extend(part)
+        _windows_in_band(windows, claims, k0*nj, nj)
+    _write_shared_cells(ds, *table)
+    _write_label_windows(ds, windows)
 
 
 def _add_world_mask_binary(ds):
-    # Add world mask from existing countries
+    # Add world mask from existing countries, in bands of chunk rows, and the shared cells table along
     print("Create world mask (binary)")
-    shp = ds['lat'].size, ds["lon"].size
-    world_mask = np.zeros(shp, dtype=bool)
-    for m in ds.variables:
-        if not m.startswith('m_'):
-            continue
-        mask = ds[m][:].filled(0) > 0
-        world_mask |= mask
+    ni, nj = ds['lat'].size, ds["lon"].size
+    variable = _first_country_variable(ds)
+    regions = [m for m in ds.variables if m.startswith('m_') and m != 'm_world']
+    labels = {m: k for k, m in enumerate(_country_variables(ds), 1)}
     try:
-        world = ds.createVariable('m_world', "i1", ("lat", "lon"), zlib=True)
+        world = _create_mask_variable(ds, 'm_world', "i1", **_mask_encoding(variable))
     except RuntimeError:
         world = ds['m_world']
-    world[:] = world_mask
+    step = _band_step(variable)
+    table = [], [], []
+    windows = {}
+    for k in range(0, ni, step):
+        band = np.s_[k:k+step]
+        world_mask = np.zeros((min(step, ni-k), nj), dtype=bool)
+        claims = {}
+        for m in regions:
+            mask = ds[m][band].filled(0)
+            world_mask |= mask > 0
+            if m in labels:
+                index = np.flatnonzero(mask)
+                if index.size > 0:
+                    claims[labels[m]] = index, mask.flat[index]
+        world[band] = world_mask
+        for t, part in zip(table, _shared_in_band(claims, world_mask.shape[0]*nj, k*nj)):
+            t.extend(part)
+        _windows_in_band(windows, claims, k*nj, nj)
     ds['m_world'].long_name = 'World'
-
-
-def make_binary_mask(file_name, js, res, version=None, all_touched=True):
-
-    ds = init_dataset(file_name, js, res, version)
+    _write_shared_cells(ds, *table)
+    _write_label_windows(ds, windows)
+
+
+def _rasterize_feature(task):
+    """rasterize one geometry (passed as WKB) within its grid window
+
+    This is the unit of work sent to worker processes when running with --jobs.
+    Return (mask, (i0, j0), error, seconds), where error is only calculated for fractional
+    masks with report_error=True, and seconds is the time spent.
+    """
+    t0 = time.time()
+    wkb, res, fractional, kwargs = task
+    geom = shapely.wkb.loads(wkb)
+    coords = grid_coords(res)
+    if not fractional:
+        mask, offsets = polygon_to_mask(geom, coords, window=True, **kwargs)
+        return mask, offsets, None, time.time()-t0
+    mask, offsets = polygon_to_fractional_mask(geom, coords, window=True, exact=kwargs.get('exact', False))
+    error = fractional_mask_error(geom, coords) if kwargs.get('report_error') else None
+    return mask, offsets, error, time.time()-t0
+
+
+def rasterize_features(features, res, fractional=False, jobs=1, cache=None, **kwargs):
+    """iterate over the rasterized features, in the order of features
+
+    jobs: number of worker processes (the results are yielded in order regardless)
+    cache: MaskCache instance, to only rasterize the features not found in cache
+    **kwargs: passed to polygon_to_mask or polygon_to_fractional_mask
+    """
+    tasks = ((c['wkb'], res, fractional, kwargs) for c in features)
+    if cache is None:
+        yield from _map_tasks(tasks, jobs)
+        return
+
+    tasks = list(tasks)
+    keys = [cache.key(*task) for task in tasks]
+    # decide once which tasks to compute: identical geometries share a key (e.g. a group of one country)
+    found = [key in cache for key in keys]
+    print(f"Cache: {sum(found)} of {len(tasks)} masks found in {cache.path}")
+    computed = _map_tasks([task for task, hit in zip(tasks, found) if not hit], jobs)
+    for task, key, hit in zip(tasks, keys, found):
+        cached = cache.get(key) if hit else None
+        if cached is not None:
+            yield cached + (0.,)
+            continue
+        mask, offsets, error, seconds = next(computed) if not hit else _rasterize_feature(task)  # evicted meanwhile
+        cache.put(key, mask, offsets, error)
+        yield mask, offsets, error, seconds
+
+
+def _map_tasks(tasks, jobs=1, func=_rasterize_feature):
+    """map func over tasks, in order, with at most 2*jobs tasks submitted to the workers at a time,
+    so that finished results do not pile up while the writer falls behind (see _band_rows)
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= 2*jobs:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(func, task))
+            while pending:
+                yield pending.popleft().result()
+    else:
+        yield from map(func, tasks)
+
+
+def _rasterize_band(task):
+    """rasterize the grid rows i0:i1 of a fractional mask (see fractional_mask_band)
+
+    Return (i0, j0, shape, encoded, seconds), with the compact encoding of encode_fractional_mask,
+    so that the results waiting to be written take little memory.
+    """
+    t0 = time.time()
+    wkb, res, i0, i1, exact = task
+    mask, j0 = fractional_mask_band(shapely.wkb.loads(wkb), grid_coords(res), i0, i1, exact=exact)
+    return i0, j0, mask.shape, encode_fractional_mask(mask), time.time()-t0
+
+
+def _band_tasks(wkb, res, rows, step, exact=False):
+    """split the geometry window into bands of at most `rows` grid rows, within chunk bands of `step` rows
+    """
+    coords = grid_coords(res)
+    i0, i1, _, _ = grid_window(shapely.wkb.loads(wkb).bounds, coords)
+    tasks = []
+    for k in range(i0 // step * step, i1, step):
+        for a in range(max(k, i0), min(k+step, i1), rows):
+            tasks.append((wkb, res, a, min(a+rows, k+step, i1), exact))
+    return tasks
+
+
+def rasterize_features_banded(features, res, rows, step, jobs=1, exact=False):
+    """iterate over the fractional masks of features, in the order of features, computed in bands of at most `rows` grid rows
+
+    Yield (bands, seconds) for each feature, where bands iterates over (i0, j0, mask) for _write_bands.
+    """
+    tasks = [_band_tasks(c['wkb'], res, rows, step, exact) for c in features]
+    results = _map_tasks((task for feature_tasks in tasks for task in feature_tasks), jobs, func=_rasterize_band)
+    for feature_tasks in tasks:
+        encoded = [next(results) for _ in feature_tasks]
+        # decoded one band at a time, while writing
+        bands = ((i0, j0, decode_fractional_mask(e, shape)) for i0, j0, shape, e, _ in encoded)
+        yield bands, sum(seconds for *_, seconds in encoded)
+
+
+def _band_rows(memory_budget, nj, step, jobs=1):
+    """number of grid rows per band so that the workers and the writer fit in memory_budget (bytes)
+
+    Rough estimate: a worker needs ~32 bytes per grid cell of its band (float64 masks and boolean
+    masks of the window, indices of marginal cells) plus ~200 MB (supersampling batches, geometry),
+    each of the up to 2*jobs bands in flight (see _map_tasks) ~12 bytes per grid cell once encoded
+    (at worst, all cells marginal), and the writer ~16 bytes per grid cell of a chunk band (float32 band, world mask).
+    """
+    available = memory_budget - jobs*200e6 - 16*nj*step
+    rows = int(available // ((32 + 2*12)*nj*jobs))
+    if rows < 1:
+        raise ValueError(f"memory budget of {memory_budget/1e6:.0f} MB is too small for {jobs} jobs")
+    return min(rows, step)
+
+
+def _skip_completed(ds, countries):
+    """return the countries whose mask variable is not complete yet in ds (see --resume)
+    """
+    completed = _completed_variables(ds)
+    todo = [c for c in countries if 'm_'+c['properties']['ISIPEDIA'] not in completed]
+    print(f"Resume {ds.filepath()}: {len(countries)-len(todo)} variables already complete, {len(todo)} to go")
+    return todo
+
+
+def select_shard(features, i, n):
+    """return the features of shard i (0 <= i < n), sorted by ISIPEDIA code
+
+    Features are distributed among the n shards so that the total number of
+    vertices per shard is balanced (largest first, to the least loaded shard).
+    The result only depends on the features, so that every shard of a SLURM
+    array job makes the same split.
+    """
+    weights = [(-int(shapely.get_num_coordinates(shapely.from_wkb(c['wkb']))), c['properties']['ISIPEDIA'], c) for c in features]
+    loads = [0]*n
+    shards = [[] for _ in range(n)]
+    for weight, code, c in sorted(weights, key=lambda w: w[:2]):
+        k = loads.index(min(loads))
+        loads[k] -= weight
+        shards[k].append(c)
+    return list(sorted(shards[i], key=lambda c: c['properties']['ISIPEDIA']))
+
+
+def _centroid_cell(geom, lon, lat, res):
+    """(i, j) of the grid cell of the centroid, marked for features too small to cover any grid cell"""
+    [(lo, la)] = geom.centroid.coords[:]
+    return int(round(-(la-lat[0])/res)), int(round((lo-lon[0])/res))
+
+
+def make_binary_mask(file_name, js, res, version=None, all_touched=True, encoding=None, jobs=1, shard=None, resume=False, cache=None):
+
+    ds = init_dataset(file_name, js, res, version, resume=resume)
     if all_touched:
         ds.note = 'Any grid cell that is "touched" by a polygon is marked as belonging to that country. Note bordering grid cells will be marked as belonging to several countries.'
     else:
         ds.note = 'Any grid cell whose center is contained in a polygon is marked as belonging to that country. Each grid cell belongs to a single country, but some coastal grid cells may be left out (e.g. tiny island).'
     lon, lat = ds['lon'][:], ds['lat'][:]
 
-    countries = js['features']
+    countries = list(sorted(js['features'], key=lambda c: c['properties']['ISIPEDIA']))
+    if shard:
+        countries = select_shard(countries, *shard)
+        ds.shard = '{}/{}'.format(*shard)
+    if resume:
+        countries = _skip_completed(ds, countries)
+    results = rasterize_features(countries, res, jobs=jobs, cache=cache, all_touched=all_touched)
 
-    for c in tqdm.tqdm(list(sorted(countries, key=lambda c: c['properties']['ISIPEDIA']))):
+    for c, (mask, (i0, j0), _, seconds) in zip(tqdm.tqdm(countries), results):
         props = c['properties']
         code = props['ISIPEDIA']
         name = c['properties']['NAME']
-
-        geom = shg.shape(c['geometry'])
-        mask = polygon_to_mask(geom, (lon, lat), all_touched=all_touched)
-    #     mask = polygon_to_mask(geom, (lon, lat), all_touched=False)
+        _log_timing(file_name, code, seconds)
 
         if not np.any(mask):
             print('- '+name)
-            [(lo, la)] = geom.centroid.coords[:]
-            i = int(round(-(la-lat[0])/res))
-            j = int(round((lo-lon[0])/res))
-            mask[i, j] = True
-
-        v = ds.createVariable('m_'+code, 'i1', ('lat', 'lon'), zlib=True)
-        v[:] = mask
+            i0, j0 = _centroid_cell(shapely.from_wkb(c['wkb']), lon, lat, res)
+            mask = np.ones((1, 1), dtype=bool)
+
+        try:
+            v = _create_mask_variable(ds, 'm_'+code, 'i1', **(encoding or {}))
+        except RuntimeError:
+            v = ds['m_'+code]  # incomplete variable from an interrupted run
+        _write_window(v, mask, i0, j0)
         v.long_name = name
         if 'ISIPEDIA_NOTE' in props:
             v.note = props['ISIPEDIA_NOTE']
+        v.complete = 1
+        ds.sync()  # flush to disk, so that the marker is only seen with the data
 
-    _add_world_mask_binary(ds)
+    if not shard:
+        _add_world_mask_binary(ds)
+
+    return ds
+
+
+def make_binary_mask_single_pass(file_name, js, res, version=None, label_mask=False, encoding=None):
+    """Same as make_binary_mask with all_touched=False, but all countries are burned
+    into one label raster in a single pass (precedence according to alphabetical order),
+    from which the country, group and world masks are derived.
+    """
+    ds = init_dataset(file_name, js, res, version)
+    ds.note = 'Any grid cell whose center is contained in a polygon is marked as belonging to that country. Each grid cell belongs to a single country, but some coastal grid cells may be left out (e.g. tiny island).'
+    lon, lat = ds['lon'][:], ds['lat'][:]
+
+    countries = [c for c in sorted(js['features'], key=lambda c: c['properties']['ISIPEDIA']) if c['properties']['ISIPEDIA'] not in group_codes]
+    geoms = [shapely.from_wkb(c['wkb']) for c in countries]
+
+    print("Rasterize", len(countries), "countries in a single pass")
+    labels = polygons_to_labels(geoms, (lon, lat), all_touched=False)
+    slices = find_objects(labels, max_label=len(countries))
+
+    for k, (c, geom, sl) in enumerate(zip(countries, geoms, slices), 1):
+        if sl is None:
+            print('- '+c['properties']['NAME'])
+            i, j = _centroid_cell(geom, lon, lat, res)
+            # mimic make_exclusive: the pixel goes to the first country in alphabetical order
+            if labels[i, j] == 0 or labels[i, j] > k:
+                labels[i, j] = k
+            slices[k-1] = np.s_[i:i+1, j:j+1]
+
+    index = {c['properties']['ISIPEDIA']: k for k, c in enumerate(countries, 1)}
+    world_mask = labels > 0
+
+    for c in tqdm.tqdm(list(sorted(js['features'], key=lambda c: c['properties']['ISIPEDIA']))):
+        props = c['properties']
+        code = props['ISIPEDIA']
+        v = _create_mask_variable(ds, 'm_'+code, 'i1', **(encoding or {}))
+        if code in index:
+            k = index[code]
+            sl = slices[k-1]
+            _write_window(v, labels[sl] == k, sl[0].start, sl[1].start)
+        else:
+            # groups are rasterized from their own geometry, as in make_binary_mask
+            geom = shapely.from_wkb(c['wkb'])
+            mask, (i0, j0) = polygon_to_mask(geom, (lon, lat), all_touched=False, window=True)
+            if not mask.any():
+                print('- '+props['NAME'])
+                i0, j0 = _centroid_cell(geom, lon, lat, res)
+                mask = np.ones((1, 1), dtype=bool)
+            _write_window(v, mask, i0, j0)
+            world_mask[i0:i0+mask.shape[0], j0:j0+mask.shape[1]] |= mask
+        v.long_name = props['NAME']
+        if 'ISIPEDIA_NOTE' in props:
+            v.note = props['ISIPEDIA_NOTE']
+
+    print("Create world mask (binary)")
+    world = _create_mask_variable(ds, 'm_world', 'i1', **(encoding or {}))
+    world[:] = world_mask
+    world.long_name = 'World'
+    _write_shared_cells(ds, [], [], [])  # exclusive by construction
+
+    if label_mask:
+        # same labels as exclusive_country_masks_as_one_labelled_array
+        _add_exclusive_label_mask(ds, labels.astype(_label_dtype(len(countries))), [c['properties']['ISIPEDIA'] for c in countries])
 
     return ds
 
@@ -180,132 +822,646 @@ def is_country(m):
 
 
 def _add_world_mask_fractional(ds):
-
+    """Add the world mask, normalize the grid cells where countries add up to more than 1,
+    and compute the groups again from the normalized countries.
+
+    The grid is processed in bands of chunk rows, so that memory is bounded by one band
+    (only the non-zero cells of each country are kept within a band), and each country
+    is read once and only written where normalized. The table of shared cells is written
+    along (see shared_cells).
+    """
     print("Create world mask (fractional)")
-    variable = ds.variables['m_AFG']
-
-    # World mask
-    world_mask = np.zeros(variable.shape, dtype=variable.dtype)
+    variable = _first_country_variable(ds)
+    countries = []
     for m in ds.variables:
         if not is_country(m):
             print("skip", m)
             continue
-        mask = ds[m][:].filled(0)
-        world_mask += mask
-
-    print("World mask ranges from", np.min(world_mask[world_mask>0]), "to", np.max(world_mask))
-    # Normalization
-    # check grid points where mask > 1, and scale it back
-    iis, jjs = np.where(world_mask > 1)
-
-    for ii, jj in zip(iis, jjs):
-        print("normalize", ii, jj, world_mask[ii, jj])
-        for m in ds.variables:
-            if not is_country(m):
-                continue
-            value = ds[m][ii,jj].filled(0)
-            if value > 0:
-                newvalue = value / world_mask[ii, jj]
-                print("    -", m[2:], value, "=>", newvalue)
-                ds[m][ii, jj] = newvalue
-        world_mask[ii, jj] = 1
-
-    assert not np.any(world_mask > 1)
-#     world_mask[world_mask > 1] = 1
+        countries.append(m)
 
-    # Compute groups again
+    groups = {}
     for group in grouping['groups']:
-        m = "m_"+group["ISIPEDIA"]
-#         assert not np.any(ds[m][:].filled(0) > 1), (m, 'has some grid cells > 1')
-
-        group_mask = np.zeros(variable.shape, dtype=variable.dtype)
+        codes = []
         for code in group["country_codes"]:
-            try:
-                group_mask += ds.variables[f"m_{code}"][:].filled(0)
-            except KeyError:
+            if f"m_{code}" not in ds.variables:
                 print(code, "not found in countrymasks")
                 continue
-        assert not np.any(group_mask > 1)
-        ds[m][:] = group_mask
+            codes.append(f"m_{code}")
+        groups["m_"+group["ISIPEDIA"]] = codes
 
     try:
-        world = ds.createVariable('m_world', variable.datatype, variable.dimensions, zlib=True)
+        world = _create_mask_variable(ds, 'm_world', variable.datatype, **_mask_encoding(variable))
     except RuntimeError:
         world = ds['m_world']
-    world[:] = world_mask + 0.
+
+    ni, nj = variable.shape
+    step = _band_step(variable)
+    vmin, vmax, n_overlap = np.inf, 0, 0
+    normalized = dict.fromkeys(countries, 0)
+    labels = {m: k for k, m in enumerate(countries, 1)}
+    table = [], [], []
+    windows = {}
+
+    for k in range(0, ni, step):
+        band = np.s_[k:k+step]
+        world_mask = np.zeros((min(step, ni-k), nj), dtype=variable.dtype)
+        nonzero = {}  # flat index and values of each country in the band
+        for m in countries:
+            mask = ds[m][band].filled(0)
+            index = np.flatnonzero(mask)
+            if index.size > 0:
+                nonzero[m] = index, mask.flat[index]
+                world_mask.flat[index] += nonzero[m][1]
+        if world_mask.any():
+            vmin, vmax = min(vmin, world_mask[world_mask > 0].min()), max(vmax, world_mask.max())
+
+        # Normalization: check grid points where mask > 1, and scale it back
+        overlap = world_mask > 1
+        n_overlap += overlap.sum()
+        if overlap.any():
+            for m, (index, values) in nonzero.items():
+                sub = overlap.flat[index]
+                if not sub.any():
+                    continue
+                values[sub] = values[sub] / world_mask.flat[index[sub]]
+                mask = np.zeros_like(world_mask)
+                mask.flat[index] = values
+                ds[m][band] = mask
+                normalized[m] += sub.sum()
+            world_mask[overlap] = 1
+
+        assert not np.any(world_mask > 1)
+        world[band] = world_mask
+        claims = {labels[m]: nonzero[m] for m in nonzero}
+        for t, part in zip(table, _shared_in_band(claims, world_mask.size, k*nj)):
+            t.extend(part)
+        _windows_in_band(windows, claims, k*nj, nj)
+
+        # Compute groups again
+        for g, codes in groups.items():
+            group_mask = np.zeros_like(world_mask)
+            for m in codes:
+                if m in nonzero:
+                    index, values = nonzero[m]
+                    group_mask.flat[index] += values
+            assert not np.any(group_mask > 1)
+            ds[g][band] = group_mask
+
+    print("World mask ranges from", vmin, "to", vmax)
+    print("Normalize", n_overlap, "grid cells where world mask > 1")
+    for m, n in normalized.items():
+        if n > 0:
+            print("    -", m[2:], n, "grid cells normalized")
+
     # copy variable attributes all at once via dictionary
-    ds['m_world'].setncatts(vars(variable))
+    ds['m_world'].setncatts({k: v for k, v in vars(variable).items() if k != '_FillValue'})
     ds['m_world'].long_name = 'World'
+    _write_shared_cells(ds, *table)
+    _write_label_windows(ds, windows)
 
 
-def make_fractional_mask(file_name, js, res, version=None):
+def make_fractional_mask(file_name, js, res, version=None, exact=False, report_error=False, encoding=None, jobs=1, shard=None, resume=False, cache=None, memory_budget=None):
+    """
+    memory_budget: if provided (in bytes), rasterize countries in bands of grid rows sized to fit in
+        that budget, instead of whole windows (needed at 30arcsec). The cache and report_error are not used then.
+    """
 
-    ds = init_dataset(file_name, js, res, version)
+    ds = init_dataset(file_name, js, res, version, resume=resume)
     ds.note = 'Fractional mask'
+    if exact:
+        ds.note += ' (exact intersection area of marginal grid cells)'
 
     lon, lat = ds['lon'][:], ds['lat'][:]
 
-    countries = js['features']
+    countries = list(sorted(js['features'], key=lambda c: c['properties']['ISIPEDIA']))
+    if shard:
+        countries = select_shard(countries, *shard)
+        ds.shard = '{}/{}'.format(*shard)
+    if resume:
+        countries = _skip_completed(ds, countries)
+    if memory_budget:
+        step = min((encoding or {}).get('chunksizes', (lat.size,))[0], lat.size)
+        rows = _band_rows(memory_budget, lon.size, step, jobs)
+        print(f"Memory budget of {memory_budget/1e6:.0f} MB: rasterize in bands of up to {rows} grid rows")
+        results = ((bands, None, None, seconds) for bands, seconds in rasterize_features_banded(countries, res, rows, step, jobs=jobs, exact=exact))
+    else:
+        results = rasterize_features(countries, res, fractional=True, jobs=jobs, cache=cache, exact=exact, report_error=report_error)
+    errors = {}
 
-    for c in tqdm.tqdm(list(sorted(countries, key=lambda c: c['properties']['ISIPEDIA']))):
+    # mask is a list of bands with memory_budget, otherwise a window at offsets (i0, j0)
+    for c, (mask, offsets, error, seconds) in zip(tqdm.tqdm(countries), results):
         props = c['properties']
         code = props['ISIPEDIA']
         name = c['properties']['NAME']
+        _log_timing(file_name, code, seconds)
 
         print(code, name)
-        geom = shg.shape(c['geometry'])
-        mask = polygon_to_fractional_mask(geom, (lon, lat))
 
-        v = ds.createVariable('m_'+code, 'f', ('lat', 'lon'), zlib=True)
-        v[:] = mask
+        if report_error:
+            errors[code] = error
+            print(f"{code}: max fraction error of supersampling vs exact: {errors[code]:.4f}")
+
+        try:
+            v = _create_mask_variable(ds, 'm_'+code, 'f', **(encoding or {}))
+        except RuntimeError:
+            v = ds['m_'+code]  # incomplete variable from an interrupted run
+        if memory_budget:
+            _write_bands(v, mask)
+        else:
+            _write_window(v, mask, *offsets)
         v.long_name = name
         if 'ISIPEDIA_NOTE' in props:
             v.note = props['ISIPEDIA_NOTE']
+        v.complete = 1
+        ds.sync()  # flush to disk, so that the marker is only seen with the data
+
+    if errors:
+        worst = max(errors, key=errors.get)
+        print(f"Max fraction error of supersampling vs exact: {errors[worst]:.4f} ({worst})")
+
+    if not shard:
+        _add_world_mask_fractional(ds)
+
+    return ds
+
+
+
+def make_coarser_mask(file_name, fine, res, encoding=None):
+    """Derive the masks of a coarser nested grid from the (complete) fine dataset, by block
+    averaging for fractional masks, and block OR for binary masks, so that both resolutions are
+    consistent by construction. The world (and group) masks are then computed as usual.
+    """
+    fractional = _first_country_variable(fine).datatype.kind == 'f'
+    fine_res = abs(float(fine['lon'][1] - fine['lon'][0]))
+    factor = int(round(res / fine_res))
+    if abs(factor * fine_res - res) > 1e-9 * res:
+        raise ValueError(f"{res} is not a multiple of the fine grid resolution {fine_res}")
+
+    lon, lat = grid_coords(res)
+    ds = nc.Dataset(file_name, 'w')
+    ds.setncatts({k: fine.getncattr(k) for k in fine.ncattrs()})
+    ds.note = fine.note + f" Derived from the {fine_res*3600:.0f} arcsec grid by block {'averaging' if fractional else 'OR'}."
+    for name, values in [('lon', lon), ('lat', lat)]:
+        ds.createDimension(name, values.size)
+        v = ds.createVariable(name, float, name)
+        v[:] = values
+        v.setncatts({k: fine[name].getncattr(k) for k in fine[name].ncattrs()})
+
+    for m in tqdm.tqdm([m for m in fine.variables if m.startswith('m_') and m != 'm_world']):
+        v = _create_mask_variable(ds, m, fine[m].datatype, **(encoding or _mask_encoding(fine[m])))
+        v.setncatts({k: fine[m].getncattr(k) for k in fine[m].ncattrs() if k != '_FillValue'})
+        band = _band_step(v)
+        for k in range(0, lat.size, band):
+            values = fine[m][k*factor:(k+band)*factor].filled(0)
+            v[k:k+band] = block_reduce(values, factor, how='mean' if fractional else 'any')
+
+    if fractional:
+        _add_world_mask_fractional(ds)
+    else:
+        _add_world_mask_binary(ds)
+
+    return ds
 
-    _add_world_mask_fractional(ds)
+
+def compare_with_direct(ds, js, res, fractional=False, jobs=1, cache=None):
+    """report the difference between the country masks in ds (e.g. from make_coarser_mask) and direct rasterization
+
+    Note the direct fractional masks are not normalized where countries overlap.
+    """
+    print(f"Compare {ds.filepath()} with direct rasterization")
+    countries = [c for c in sorted(js['features'], key=lambda c: c['properties']['ISIPEDIA']) if 'm_'+c['properties']['ISIPEDIA'] in ds.variables and is_country('m_'+c['properties']['ISIPEDIA'])]
+    kwargs = {} if fractional else {'all_touched': True}
+    diffs = {}
+    for c, (mask, (i0, j0), _, _) in zip(countries, rasterize_features(countries, res, fractional=fractional, jobs=jobs, cache=cache, **kwargs)):
+        code = c['properties']['ISIPEDIA']
+        derived = ds['m_'+code][:].filled(0).astype(float)
+        direct = np.zeros_like(derived)
+        direct[i0:i0+mask.shape[0], j0:j0+mask.shape[1]] = mask
+        diffs[code] = np.abs(derived - direct).max()
+        n = np.sum(derived != direct) if not fractional else np.sum(np.abs(derived - direct) > 1e-3)
+        print(f"{code}: max difference {diffs[code]:.4f}, {n} grid cells differ, total {derived.sum():.2f} vs {direct.sum():.2f} (direct)")
+    if diffs:
+        worst = max(diffs, key=diffs.get)
+        print(f"Max difference with direct rasterization: {diffs[worst]:.4f} ({worst})")
+
+
+def write_sparse_layout(ds, file_name):
+    """Write a copy of the masks in ds with a compressed-sparse layout: for every region
+    (country, group or world), only the flat grid cell indices (lat, lon order) of its
+    non-zero grid cells and the corresponding mask values are stored, one region after the
+    other along the `cell` dimension. Region k occupies cells `region_start[k]` to
+    `region_start[k] + region_count[k]`.
+
+    See country_data.read_region to expand a region back to the full grid.
+    """
+    print("Write sparse layout to", file_name)
+    regions = [m for m in ds.variables if m.startswith('m_')]
+
+    with nc.Dataset(file_name, 'w') as sparse:
+        sparse.setncatts({k: ds.getncattr(k) for k in ds.ncattrs()})
+        sparse.layout = 'sparse'
+
+        sparse.createDimension('lon', ds['lon'].size)
+        sparse.createDimension('lat', ds['lat'].size)
+        sparse.createDimension('region', len(regions))
+        sparse.createDimension('cell', None)
+        for name in ['lon', 'lat']:
+            v = sparse.createVariable(name, ds[name].datatype, name)
+            v[:] = ds[name][:]
+            v.setncatts({k: ds[name].getncattr(k) for k in ds[name].ncattrs()})
+
+        region = sparse.createVariable('region', str, 'region')
+        long_name = sparse.createVariable('region_name', str, 'region')
+        start = sparse.createVariable('region_start', 'i8', 'region')
+        count = sparse.createVariable('region_count', 'i8', 'region')
+        index = sparse.createVariable('cell_index', 'i4', 'cell', zlib=True)
+        index.long_name = 'flat index of the grid cell in the (lat, lon) grid'
+        value = sparse.createVariable('cell_value', ds[regions[0]].datatype, 'cell', zlib=True)
+        value.long_name = 'mask value of the grid cell'
+
+        ni, nj = ds['lat'].size, ds['lon'].size
+        n = 0
+        for k, m in enumerate(tqdm.tqdm(regions)):
+            region[k] = m[2:]
+            long_name[k] = getattr(ds[m], 'long_name', m[2:])
+            start[k] = n0 = n
+            # one chunk band at a time, instead of the full grid
+            step = _band_step(ds[m])
+            for i0 in range(0, ni, step):
+                band = ds[m][i0:i0+step].filled(0).ravel()
+                ii = np.flatnonzero(band)
+                index[n:n+ii.size] = ii + i0*nj
+                value[n:n+ii.size] = band[ii]
+                n += ii.size
+            count[k] = n - n0
+
+
+# fractions of marginal grid cells are stored as uint16 in the compact layout: fraction = q / FRACTION_SCALE,
+# with an error of at most 0.5 / FRACTION_SCALE (7.6e-6) per grid cell
+FRACTION_SCALE = 65535
+
+
+def _runs(flags):
+    """return (start, length) of the runs of True values in a 1-D boolean array
+    """
+    edges = np.diff(np.concatenate([[0], flags.view(np.int8), [0]]))
+    start, end = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return start, end - start
+
+
+def write_compact_layout(ds, file_name):
+    """Write a copy of the masks in ds with a compact layout meant for fractional masks: for
+    every region, the grid cells equal to 1 (interior) are stored as runs of flat grid cell
+    indices (lat, lon order) along the `run` dimension, and the other non-zero (marginal) grid
+    cells as flat index and uint16-quantized fraction along the `margin` dimension.
+    Region k occupies runs `region_run_start[k]` to `region_run_start[k] + region_run_count[k]`,
+    and likewise for margins.
+
+    The quantization error is at most 0.5 / FRACTION_SCALE per grid cell, so that the area of a
+    region is within 7.6e-6 times the area of its marginal cells.
+
+    See country_data.read_region to expand a region back to the full grid.
+    """
+    print("Write compact layout to", file_name)
+    regions = [m for m in ds.variables if m.startswith('m_')]
+    ni, nj = ds['lat'].size, ds['lon'].size
+    step = _band_step(ds[regions[0]])
+
+    with nc.Dataset(file_name, 'w') as compact:
+        compact.setncatts({k: ds.getncattr(k) for k in ds.ncattrs()})
+        compact.layout = 'compact'
+
+        compact.createDimension('lon', nj)
+        compact.createDimension('lat', ni)
+        compact.createDimension('region', len(regions))
+        compact.createDimension('run', None)
+        compact.createDimension('margin', None)
+        for name in ['lon', 'lat']:
+            v = compact.createVariable(name, ds[name].datatype, name)
+            v[:] = ds[name][:]
+            v.setncatts({k: ds[name].getncattr(k) for k in ds[name].ncattrs()})
+
+        region = compact.createVariable('region', str, 'region')
+        long_name = compact.createVariable('region_name', str, 'region')
+        run_start = compact.createVariable('region_run_start', 'i8', 'region')
+        run_count = compact.createVariable('region_run_count', 'i8', 'region')
+        margin_start = compact.createVariable('region_margin_start', 'i8', 'region')
+        margin_count = compact.createVariable('region_margin_count', 'i8', 'region')
+        start = compact.createVariable('run_start', 'i4', 'run', zlib=True)
+        start.long_name = 'flat index of the first grid cell of a run of grid cells equal to 1'
+        length = compact.createVariable('run_length', 'i4', 'run', zlib=True)
+        length.long_name = 'number of grid cells in the run'
+        index = compact.createVariable('margin_index', 'i4', 'margin', zlib=True)
+        index.long_name = 'flat index of the marginal grid cell in the (lat, lon) grid'
+        # the default fill value of u2 (65535, masked on reading) is also the quantized fraction of
+        # 1 - 7.6e-6 < f < 1, whereas 0 is never stored
+        fraction = compact.createVariable('margin_fraction', 'u2', 'margin', zlib=True, fill_value=0)
+        fraction.long_name = 'mask value of the marginal grid cell'
+        fraction.scale_factor = 1/FRACTION_SCALE  # unpacked on read by netCDF4 and xarray
+        fraction.set_auto_scale(False)  # written already quantized
+
+        n_runs, n_margins = 0, 0
+        for k, m in enumerate(tqdm.tqdm(regions)):
+            region[k] = m[2:]
+            long_name[k] = getattr(ds[m], 'long_name', m[2:])
+            first_run, first_margin = n_runs, n_margins
+            run_start[k], margin_start[k] = first_run, first_margin
+            # read in bands of chunk rows, to bound memory at high resolution
+            for i0 in range(0, ni, step):
+                mask = ds[m][i0:i0+step].filled(0).ravel()
+                offset = i0*nj
+                starts, lengths = _runs(mask == 1)
+                start[n_runs:n_runs+starts.size] = starts + offset
+                length[n_runs:n_runs+starts.size] = lengths
+                n_runs += starts.size
+                ii = np.flatnonzero((mask != 0) & (mask != 1))
+                # clipped, so that fractions slightly above 1 after normalization do not wrap around
+                q = np.round(np.clip(mask[ii], 0, 1) * FRACTION_SCALE).astype(np.uint16)
+                ii, q = ii[q > 0], q[q > 0]
+                index[n_margins:n_margins+ii.size] = ii + offset
+                fraction[n_margins:n_margins+ii.size] = q
+                n_margins += ii.size
+            run_count[k], margin_count[k] = n_runs - first_run, n_margins - first_margin
+
+
+def write_packed_layout(ds, file_name):
+    """Write a copy of the binary masks in ds, bit-packed along longitude (see bitmask.BitMask):
+    every `m_XXX` variable has dimensions (lat, lon_packed), with 8 grid cells per byte.
+
+    See country_data.read_region to unpack a region.
+    """
+    print("Write packed layout to", file_name)
+    regions = [m for m in ds.variables if m.startswith('m_')]
+    ni, nj = ds['lat'].size, ds['lon'].size
+
+    with nc.Dataset(file_name, 'w') as packed:
+        packed.setncatts({k: ds.getncattr(k) for k in ds.ncattrs()})
+        packed.layout = 'packed'
+
+        packed.createDimension('lon', nj)
+        packed.createDimension('lat', ni)
+        packed.createDimension('lon_packed', (nj+7)//8)
+        for name in ['lon', 'lat']:
+            v = packed.createVariable(name, ds[name].datatype, name)
+            v[:] = ds[name][:]
+            v.setncatts({k: ds[name].getncattr(k) for k in ds[name].ncattrs()})
+
+        for m in tqdm.tqdm(regions):
+            encoding = _mask_encoding(ds[m])
+            encoding.pop('least_significant_digit', None)
+            if 'chunksizes' in encoding:
+                ci, cj = encoding['chunksizes']
+                encoding['chunksizes'] = ci, min(max(cj//8, 1), (nj+7)//8)
+            # every chunk is written: no fill value, so that packed bytes of 255 are not masked on read
+            v = packed.createVariable(m, 'u1', ('lat', 'lon_packed'), fill_value=False, **encoding)
+            v.setncatts({k: ds[m].getncattr(k) for k in ds[m].ncattrs() if k != '_FillValue'})
+            step = _band_step(ds[m])
+            for k in range(0, ni, step):
+                v[k:k+step] = BitMask.from_array(ds[m][k:k+step].filled(0) > 0).bits
+
+
+def merge_shards(file_name, shard_files):
+    """Combine the country variables of shard files (see --shard) into file_name,
+    and add the world mask (and group masks for fractional masks).
+
+    Return the open dataset, for further processing (exclusivity, labels).
+    """
+    shards = [nc.Dataset(f) for f in shard_files]
+    first = shards[0]
+    sources = {m: shard for shard in shards for m in shard.variables if m.startswith('m_')}
+
+    ds = nc.Dataset(file_name, 'w')
+    ds.setncatts({k: first.getncattr(k) for k in first.ncattrs() if k != 'shard'})
+    for name in ['lon', 'lat']:
+        ds.createDimension(name, first[name].size)
+        v = ds.createVariable(name, first[name].datatype, name)
+        v[:] = first[name][:]
+        v.setncatts({k: first[name].getncattr(k) for k in first[name].ncattrs()})
+
+    for m in tqdm.tqdm(sorted(sources)):
+        src = sources[m]
+        v = _create_mask_variable(ds, m, src[m].datatype, **_mask_encoding(src[m]))
+        v.setncatts({k: src[m].getncattr(k) for k in src[m].ncattrs() if k != '_FillValue'})
+        step = _band_step(src[m])
+        for k in range(0, src[m].shape[0], step):
+            v[k:k+step] = src[m][k:k+step]
+
+    for shard in shards:
+        shard.close()
+
+    if ds[next(iter(sorted(sources)))].datatype.kind == 'f':
+        _add_world_mask_fractional(ds)
+    else:
+        _add_world_mask_binary(ds)
 
     return ds
 
 
+def merge_main(args=None):
+    parser = argparse.ArgumentParser(prog='geojson_to_grid.py merge', description='merge shard files written with --shard i/N')
+    parser.add_argument('shard_files', nargs='+')
+    parser.add_argument('-o', '--output', help="default: the shard file name without the _shard suffix")
+    parser.add_argument('--force-exclusivity', action="store_true", help="ensure the pixels belong to only one country")
+    parser.add_argument('--exclusivity', choices=['alphabetical', 'fraction'], default='alphabetical', help="with --force-exclusivity, give a contested grid cell to the first country in alphabetical order, or to the country with the largest fraction (also writes the label mask) (default: %(default)s)")
+    parser.add_argument('--fractional-file', help="fractional masks of the same grid for --exclusivity fraction (default: countrymasks_fractional_<grid-resolution>.nc)")
+    parser.add_argument('--label-mask', action="store_true", help="write a label mask (assuming exclusivity)")
+    parser.add_argument('--sparse-layout', action="store_true", help="also write a copy with only the non-zero grid cells of each region (*_sparse.nc)")
+    parser.add_argument('--compact-layout', action="store_true", help="fractional mask: also write a copy with runs of interior grid cells and quantized marginal fractions (*_compact.nc)")
+    parser.add_argument('--packed-layout', action="store_true", help="binary mask: also write a copy bit-packed along longitude, 8 grid cells per byte (*_packed.nc)")
+    parser.add_argument('--report-overlaps', action="store_true", help="binary mask: report the number of grid cells shared by each pair of countries (before --force-exclusivity)")
+    o = parser.parse_args(args)
+
+    if o.force_exclusivity and o.exclusivity == 'fraction' and not o.fractional_file:
+        parser.error("--exclusivity fraction: --fractional-file is required")
+    file_name = o.output or re.sub(r'_shard\d+of\d+', '', o.shard_files[0])
+    t0 = time.time()
+    with merge_shards(file_name, o.shard_files) as ds:
+        if o.report_overlaps:
+            report_overlaps(ds)
+        if o.force_exclusivity:
+            _force_exclusivity(ds, o)
+        if o.label_mask and not (o.force_exclusivity and o.exclusivity == 'fraction'):
+            _add_exclusive_label_mask(ds)
+        if o.sparse_layout:
+            write_sparse_layout(ds, file_name.replace('.nc', '_sparse.nc'))
+        if o.compact_layout:
+            write_compact_layout(ds, file_name.replace('.nc', '_compact.nc'))
+        if o.packed_layout:
+            write_packed_layout(ds, file_name.replace('.nc', '_packed.nc'))
+        encoding = _mask_encoding(_first_country_variable(ds))
+    _report_written(file_name, t0, encoding)
+
+
+def _coarser_grids(o):
+    return [(grid_resolution, res) for grid_resolution, res in RESOLUTIONS.items() if res > RESOLUTIONS[o.grid_resolution]]
+
+
+def _make_pyramid(fine, o, js, cache=None):
+    """derive the masks of the coarser grids from the fine dataset, before its exclusivity and label
+    stages, and apply these stages to each coarser file (binary masks)
+    """
+    file_name = fine.filepath()
+    fractional = _first_country_variable(fine).datatype.kind == 'f'
+    for grid_resolution, res in _coarser_grids(o):
+        coarse_file = file_name.replace(o.grid_resolution, grid_resolution)
+        encoding = _mask_encoding(_first_country_variable(fine))
+        encoding['chunksizes'] = (o.chunk_size, o.chunk_size) if o.chunk_size else DEFAULT_CHUNKSIZES[grid_resolution]
+        t0 = time.time()
+        with make_coarser_mask(coarse_file, fine, res, encoding=encoding) as coarse:
+            if o.compare_direct:
+                compare_with_direct(coarse, js, res, fractional=fractional, jobs=o.jobs, cache=cache)
+            if not fractional and o.force_exclusivity:
+                _force_exclusivity(coarse, o, o.fractional_file.replace(o.grid_resolution, grid_resolution))
+            if not fractional and o.label_mask and not (o.force_exclusivity and o.exclusivity == 'fraction'):
+                _add_exclusive_label_mask(coarse)
+        _report_written(coarse_file, t0, encoding)
+
+
+def _report_written(file_name, t0, encoding):
+    print(f"{file_name}: written in {time.time()-t0:.1f} s, {os.path.getsize(file_name)/1e6:.1f} MB ({', '.join(f'{k}={v}' for k, v in encoding.items())})")
+
 
 def main():
 
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(epilog="Use `geojson_to_grid.py merge -h` to merge shard files.")
     parser.add_argument('--geojson', default="countrymasks.geojson")
     parser.add_argument('--grid-resolution', choices=["0.5deg", "5arcmin", "30arcsec"], default="0.5deg")
     parser.add_argument('--version')
     parser.add_argument('--fractional-mask', action="store_true")
+    parser.add_argument('--exact', action="store_true", help="fractional mask: exact intersection area of marginal grid cells instead of supersampling")
+    parser.add_argument('--report-fraction-error', action="store_true", help="fractional mask: report the max error of supersampling compared to exact fractions")
     parser.add_argument('--binary-mask', action="store_true", help="all_touched=True : grid cell marked when touched by polygon")
     parser.add_argument('--binary-exclusive-mask', action="store_true", help="all_touched=False : grid cell marked when center inside polygon")
+    parser.add_argument('--single-pass', action="store_true", help="binary exclusive mask: rasterize all countries into one label raster in a single pass (exclusive by construction)")
     parser.add_argument('--force-exclusivity', action="store_true", help="ensure the pixels belong to only one country")
+    parser.add_argument('--exclusivity', choices=['alphabetical', 'fraction'], default='alphabetical', help="with --force-exclusivity, give a contested grid cell to the first country in alphabetical order, or to the country with the largest fraction (also writes the label mask) (default: %(default)s)")
+    parser.add_argument('--fractional-file', help="fractional masks of the same grid for --exclusivity fraction (default: countrymasks_fractional_<grid-resolution>.nc)")
     parser.add_argument('--label-mask', action="store_true", help="write a label mask (assuming exclusivity)")
+    parser.add_argument('--pyramid', action="store_true", help="also derive the binary (block OR) and fractional (block average) masks of all coarser grids from the --grid-resolution result (before --force-exclusivity and --label-mask, which then apply to each coarser grid)")
+    parser.add_argument('--compare-direct', action="store_true", help="with --pyramid, report the difference of derived masks with direct rasterization")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes to rasterize countries (default: %(default)s)")
+    parser.add_argument('--cache-dir', default='.mask_cache', help="cache of rasterized masks, keyed on geometry and grid (default: %(default)s)")
+    parser.add_argument('--cache-size', type=float, default=2000, help="max size of the cache in MB, least recently used masks are removed beyond (default: %(default)s)")
+    parser.add_argument('--no-cache', action="store_true", help="rasterize all countries, without reading or writing the cache")
+    parser.add_argument('--resume', action="store_true", help="continue an interrupted run: keep the country variables already complete in the output file, and redo the global stages")
+    parser.add_argument('--shard', help="i/N : only rasterize the i-th of N balanced subsets of countries (0 <= i < N) into a partial file, to be combined with the merge subcommand")
+    parser.add_argument('--memory-budget', type=float, help="fractional mask: rasterize countries in bands of grid rows to keep memory under that many MB, e.g. 8000 at 30arcsec (no cache)")
+    parser.add_argument('--chunk-size', type=int, help="chunk size (in grid cells, along lat and lon) of mask variables. Default depends on grid resolution, see DEFAULT_CHUNKSIZES")
+    parser.add_argument('--complevel', type=int, default=4, help="zlib compression level (default: %(default)s)")
+    parser.add_argument('--no-shuffle', action="store_true", help="disable the HDF5 shuffle filter")
+    parser.add_argument('--least-significant-digit', type=int, help="fractional mask: quantize values to that many decimal digits for better compression")
+    parser.add_argument('--sparse-layout', action="store_true", help="also write a copy with only the non-zero grid cells of each region (*_sparse.nc)")
+    parser.add_argument('--compact-layout', action="store_true", help="fractional mask: also write a copy with runs of interior grid cells and quantized marginal fractions (*_compact.nc)")
+    parser.add_argument('--packed-layout', action="store_true", help="binary mask: also write a copy bit-packed along longitude, 8 grid cells per byte (*_packed.nc)")
+    parser.add_argument('--report-overlaps', action="store_true", help="binary mask: report the number of grid cells shared by each pair of countries (before --force-exclusivity)")
     o = parser.parse_args()
 
-    js = json.load(open('countrymasks.geojson'))
-
-    res = {
-        "0.5deg": 0.5,
-        "5arcmin": 5/60,
-        "30arcsec": 30/3600,
-    }.get(o.grid_resolution)
+    # features with WKB geometries, from the geometry store of the geojson file (built on first use,
+    # reading one feature at a time)
+    store = GeometryStore.load(o.geojson)
+    js = {'properties': store.collection_properties, 'features': list(store.features())}
+
+    res = RESOLUTIONS[o.grid_resolution]
+
+    shard = None
+    if o.shard:
+        shard = tuple(int(x) for x in o.shard.split('/'))
+        if not 0 <= shard[0] < shard[1]:
+            parser.error(f"--shard {o.shard}: expected i/N with 0 <= i < N")
+        if o.force_exclusivity or o.label_mask or o.sparse_layout or o.compact_layout or o.packed_layout or o.report_overlaps or o.single_pass:
+            parser.error("--shard: exclusivity, label mask, sparse, compact and packed layouts, overlap report and single pass are done at the merge step")
+
+    if o.memory_budget and o.report_fraction_error:
+        parser.error("--report-fraction-error needs whole country windows and is not available with --memory-budget")
+
+    if o.fractional_file is None:
+        o.fractional_file = f'countrymasks_fractional_{o.grid_resolution}.nc'
+    if o.force_exclusivity and o.exclusivity == 'fraction' and not o.fractional_mask and not os.path.exists(o.fractional_file):
+        parser.error(f"--exclusivity fraction: {o.fractional_file} not found, add --fractional-mask or set --fractional-file")
+    if o.pyramid and o.binary_mask and o.force_exclusivity and o.exclusivity == 'fraction':
+        for grid_resolution, _ in _coarser_grids(o):
+            coarse_file = o.fractional_file.replace(o.grid_resolution, grid_resolution)
+            if coarse_file == o.fractional_file or not (o.fractional_mask or os.path.exists(coarse_file)):
+                parser.error(f"--pyramid --exclusivity fraction: no fractional masks for the {grid_resolution} grid ({coarse_file}), add --fractional-mask")
+
+    cache = None if o.no_cache else MaskCache(o.cache_dir, max_size=o.cache_size*1e6)
+
+    def output(file_name):
+        return file_name.replace('.nc', '_shard{}of{}.nc'.format(*shard)) if shard else file_name
+
+    encoding = {
+        'chunksizes': (o.chunk_size, o.chunk_size) if o.chunk_size else DEFAULT_CHUNKSIZES[o.grid_resolution],
+        'complevel': o.complevel,
+        'shuffle': not o.no_shuffle,
+    }
+    fractional_encoding = dict(encoding)
+    if o.least_significant_digit is not None:
+        fractional_encoding['least_significant_digit'] = o.least_significant_digit
+
+    # first, so that --exclusivity fraction can use it
+    if o.fractional_mask:
+        file_name = output(f'countrymasks_fractional_{o.grid_resolution}.nc')
+        t0 = time.time()
+        with make_fractional_mask(file_name, js, res, version=o.version, exact=o.exact, report_error=o.report_fraction_error, encoding=fractional_encoding, jobs=o.jobs, shard=shard, resume=o.resume, cache=cache, memory_budget=o.memory_budget and o.memory_budget*1e6) as fractional:
+            if o.sparse_layout:
+                write_sparse_layout(fractional, file_name.replace('.nc', '_sparse.nc'))
+            if o.compact_layout:
+                write_compact_layout(fractional, file_name.replace('.nc', '_compact.nc'))
+            if o.pyramid and not shard:
+                _make_pyramid(fractional, o, js, cache)
+        _report_written(file_name, t0, fractional_encoding)
 
     if o.binary_mask:
-        with make_binary_mask(f'countrymasks_{o.grid_resolution}.nc', js, res, version=o.version, all_touched=True) as binary:
+        file_name = output(f'countrymasks_{o.grid_resolution}.nc')
+        t0 = time.time()
+        with make_binary_mask(file_name, js, res, version=o.version, all_touched=True, encoding=encoding, jobs=o.jobs, shard=shard, resume=o.resume, cache=cache) as binary:
+            # coarser grids from the all_touched masks, before exclusivity and labels
+            if o.pyramid and not shard:
+                _make_pyramid(binary, o, js, cache)
+            if o.report_overlaps:
+                report_overlaps(binary)
             if o.force_exclusivity:
-                make_exclusive(binary)
-            if o.label_mask:
+                _force_exclusivity(binary, o)
+            if o.label_mask and not (o.force_exclusivity and o.exclusivity == 'fraction'):
                 _add_exclusive_label_mask(binary)
-
-    if o.binary_exclusive_mask:
-        with make_binary_mask(f'countrymasks_binary_exclusive_{o.grid_resolution}.nc', js, res, version=o.version, all_touched=False) as binary:
+            if o.sparse_layout:
+                write_sparse_layout(binary, file_name.replace('.nc', '_sparse.nc'))
+            if o.packed_layout:
+                write_packed_layout(binary, file_name.replace('.nc', '_packed.nc'))
+        _report_written(file_name, t0, encoding)
+
+    if o.binary_exclusive_mask and o.single_pass:
+        file_name = output(f'countrymasks_binary_exclusive_{o.grid_resolution}.nc')
+        t0 = time.time()
+        with make_binary_mask_single_pass(file_name, js, res, version=o.version, label_mask=o.label_mask, encoding=encoding) as binary:
+            if o.report_overlaps:
+                report_overlaps(binary)
             if o.force_exclusivity:
-                make_exclusive(binary)
-            if o.label_mask:
+                _force_exclusivity(binary, o)
+            if o.sparse_layout:
+                write_sparse_layout(binary, file_name.replace('.nc', '_sparse.nc'))
+            if o.packed_layout:
+                write_packed_layout(binary, file_name.replace('.nc', '_packed.nc'))
+        _report_written(file_name, t0, encoding)
+
+    elif o.binary_exclusive_mask:
+        file_name = output(f'countrymasks_binary_exclusive_{o.grid_resolution}.nc')
+        t0 = time.time()
+        with make_binary_mask(file_name, js, res, version=o.version, all_touched=False, encoding=encoding, jobs=o.jobs, shard=shard, resume=o.resume, cache=cache) as binary:
+            if o.report_overlaps:
+                report_overlaps(binary)
+            if o.force_exclusivity:
+                _force_exclusivity(binary, o)
+            if o.label_mask and not (o.force_exclusivity and o.exclusivity == 'fraction'):
                 _add_exclusive_label_mask(binary)
-
-    if o.fractional_mask:
-        with make_fractional_mask(f'countrymasks_fractional_{o.grid_resolution}.nc', js, res, version=o.version) as fractional:
-            pass
+            if o.sparse_layout:
+                write_sparse_layout(binary, file_name.replace('.nc', '_sparse.nc'))
+            if o.packed_layout:
+                write_packed_layout(binary, file_name.replace('.nc', '_packed.nc'))
+        _report_written(file_name, t0, encoding)
 
 if __name__ == "__main__":
     main()
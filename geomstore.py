@@ -0,0 +1,253 @@
+"""Serialized store of the geometries of countrymasks.geojson, used by geojson_to_grid.py
+
+The store keeps the WKB and bounds of each feature by ISIPEDIA code, along with the feature
+properties, in a .npz file next to the geojson (countrymasks.geomstore.npz), rebuilt when
+the geojson is newer. Geometries are only created from WKB when needed, and the spatial
+queries (bbox, intersects, nearest) go through a shapely STRtree of prepared geometries.
+
+The geojson is read one feature at a time (see iter_features), which also splits it into
+country_data/XXX/country.geojson:
+
+    python geomstore.py countrymasks.geojson --split country_data
+"""
+import os
+import json
+import mmap
+import argparse
+import tempfile
+import numpy as np
+import shapely
+import shapely.geometry as shg
+
+
+def store_file(geojson):
+    return os.path.splitext(geojson)[0] + '.geomstore.npz'
+
+
+def _structural_positions(buf, chunk_size=1 << 24):
+    """positions of the bytes { } " and \\ in buf, read in chunks (coordinates have none of them)"""
+    for k in range(0, len(buf), chunk_size):
+        a = np.frombuffer(buf[k:k+chunk_size], dtype=np.uint8)
+        yield from (k + np.flatnonzero((a == 123) | (a == 125) | (a == 34) | (a == 92))).tolist()
+
+
+def _scan(buf):
+    """yield (key, start, end) byte ranges of the objects of a FeatureCollection:
+    b'properties' for the collection, b'feature' and b'feature_properties' for each feature
+    """
+    depth = 0
+    keys = {}  # key of the current value, by depth of the object
+    starts = {}
+    in_string = False
+    escaped = -1
+    for p in _structural_positions(buf):
+        if p == escaped:
+            continue
+        ch = buf[p]
+        if in_string:
+            if ch == 92:  # backslash
+                escaped = p+1
+            elif ch == 34:
+                in_string = False
+                if buf[p+1:p+256].lstrip()[:1] == b':':
+                    keys[depth] = buf[string_start+1:p]
+        elif ch == 34:
+            in_string = True
+            string_start = p
+        elif ch == 123:  # {
+            depth += 1
+            starts[depth] = p
+            keys.pop(depth, None)
+        else:  # }
+            if depth == 2 and keys.get(1) == b'properties':
+                yield b'properties', starts[2], p+1
+            elif depth == 2 and keys.get(1) == b'features':
+                yield b'feature', starts[2], p+1
+            elif depth == 3 and keys.get(1) == b'features' and keys.get(2) == b'properties':
+                yield b'feature_properties', starts[3], p+1
+            depth -= 1
+
+
+def geojson_index(buf):
+    """Return the properties of a FeatureCollection and the list of (properties, start, end)
+    of its features in buf (bytes or mmap), in the order of the file, without parsing geometries
+    """
+    collection = {}
+    index = []
+    props = None
+    for key, start, end in _scan(buf):
+        if key == b'properties':
+            collection = json.loads(buf[start:end])
+        elif key == b'feature_properties':
+            props = json.loads(buf[start:end])
+        else:
+            index.append((props or {}, start, end))
+            props = None
+    return collection, index
+
+
+def _sorted_index(index):
+    return sorted(index, key=lambda f: f[0]['ISIPEDIA'])
+
+
+def iter_features(path, sort=True):
+    """yield (properties, geometry) for each feature of a geojson FeatureCollection, one at a time
+
+    The file is memory-mapped and scanned once for the byte range of each feature, so that only
+    one feature is parsed at a time. Geometries are geojson mappings (see shapely.geometry.shape).
+    sort: in the order of ISIPEDIA codes, instead of the order of the file
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        _, index = geojson_index(buf)
+        for props, start, end in (_sorted_index(index) if sort else index):
+            yield props, json.loads(buf[start:end])['geometry']
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class GeometryStore:
+    """Geometries of a feature collection, by ISIPEDIA code
+
+        store = GeometryStore.load('countrymasks.geojson')
+        store.geometry('FRA')
+        store.bbox(-5, 40, 10, 50)  # codes whose bounds intersect the box
+        store.intersects(geom)  # codes whose geometry intersects geom
+        store.nearest(lon, lat)  # code of the nearest geometry to each point
+
+    Queries apply to all features, including the groups of countries (e.g. CSID).
+    """
+    def __init__(self, codes, wkb, bounds, properties, collection_properties=None):
+        self.codes = list(codes)
+        self._wkb = list(wkb)
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.properties = list(properties)
+        self.collection_properties = collection_properties or {}
+        self._index = {code: k for k, code in enumerate(self.codes)}
+        self._geoms = None
+        self._tree = None
+
+    @classmethod
+    def from_geojson(cls, path, split_folder=None):
+        """build the store from a geojson file, read one feature at a time, in the order of ISIPEDIA codes
+
+        split_folder: if provided, also write each feature to split_folder/XXX/country.geojson, as in the file
+        """
+        codes, wkb, bounds, properties = [], [], [], []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            collection, index = geojson_index(buf)
+            for props, start, end in _sorted_index(index):
+                feature = buf[start:end]
+                geom = shg.shape(json.loads(feature)['geometry'])
+                codes.append(props['ISIPEDIA'])
+                wkb.append(geom.wkb)
+                bounds.append(geom.bounds)
+                properties.append(props)
+                if split_folder:
+                    os.makedirs(os.path.join(split_folder, props['ISIPEDIA']), exist_ok=True)
+                    _write_atomic(os.path.join(split_folder, props['ISIPEDIA'], 'country.geojson'), feature)
+        return cls(codes, wkb, bounds, properties, collection)
+
+    @classmethod
+    def read(cls, file_name):
+        with np.load(file_name) as npz:
+            offsets = npz['offsets']
+            data = npz['wkb'].tobytes()
+            wkb = [data[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+            meta = json.loads(str(npz['meta']))
+            return cls(npz['codes'].tolist(), wkb, npz['bounds'], meta['properties'], meta['collection_properties'])
+
+    def save(self, file_name):
+        """write the store through a temporary file in the same folder"""
+        offsets = np.cumsum([0] + [len(w) for w in self._wkb])
+        meta = json.dumps({'properties': self.properties, 'collection_properties': self.collection_properties})
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, codes=np.array(self.codes), offsets=offsets, bounds=self.bounds, meta=np.array(meta),
+                     wkb=np.frombuffer(b''.join(self._wkb), dtype=np.uint8))
+        os.replace(tmp, file_name)
+
+    @classmethod
+    def load(cls, geojson='countrymasks.geojson', file_name=None):
+        """read the store of a geojson file, or build it (and save it) if missing or older than the geojson
+        """
+        file_name = file_name or store_file(geojson)
+        if os.path.exists(file_name) and os.path.getmtime(file_name) >= os.path.getmtime(geojson):
+            return cls.read(file_name)
+        print("Build the geometry store", file_name)
+        store = cls.from_geojson(geojson)
+        store.save(file_name)
+        return store
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self._index
+
+    def wkb(self, code):
+        return self._wkb[self._index[code]]
+
+    def geometry(self, code):
+        return self.geometries()[self._index[code]]
+
+    def geometries(self):
+        """all geometries, in the order of codes (prepared)"""
+        if self._geoms is None:
+            self._geoms = shapely.from_wkb(self._wkb)
+            shapely.prepare(self._geoms)
+        return self._geoms
+
+    def features(self):
+        """iterate over the features as dicts of properties and WKB geometry (see shapely.from_wkb)"""
+        for props, wkb in zip(self.properties, self._wkb):
+            yield {'type': 'Feature', 'properties': props, 'wkb': wkb}
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries())
+        return self._tree
+
+    def _codes(self, index):
+        return [self.codes[k] for k in sorted(index)]
+
+    def bbox(self, xmin, ymin, xmax, ymax):
+        """codes whose bounds intersect the box"""
+        b = self.bounds
+        return self._codes(np.flatnonzero((b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin)))
+
+    def intersects(self, geom):
+        """codes whose geometry intersects geom"""
+        return self._codes(self.tree.query(geom, predicate='intersects'))
+
+    def nearest(self, lon, lat):
+        """code of the nearest geometry to a point, or array of codes for arrays of points
+        (the first code in the order of the store when at the same distance, e.g. inside a country and its group)
+        """
+        points = shapely.points(lon, lat)
+        point, geom = self.tree.query_nearest(np.atleast_1d(points), all_matches=True)
+        first = np.unique(point, return_index=True)[1]  # query results are sorted by point, then geometry
+        codes = np.array(self.codes)[geom[first]]
+        return str(codes[0]) if np.ndim(points) == 0 else codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('geojson', nargs='?', default='countrymasks.geojson')
+    parser.add_argument('--split', metavar='FOLDER', help="also write each feature to FOLDER/XXX/country.geojson")
+    o = parser.parse_args()
+
+    store = GeometryStore.from_geojson(o.geojson, split_folder=o.split)
+    store.save(store_file(o.geojson))
+    print(len(store), "features written to", store_file(o.geojson))
+    if o.split:
+        print(len(store), "country.geojson files written to", o.split)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ import numpy as np
 from skimage.measure import find_contours
 import rasterio
 import rasterio.mask
+import rasterio.features
+import shapely
 import shapely.ops
 from shapely.geometry import LineString, Point, MultiPoint, Polygon, MultiLineString, GeometryCollection, LinearRing, MultiPolygon
 
@@ -50,57 +52,256 @@ def mask_to_polygon(coords, mask, tol=None, minarea=0):
     return mpoly.symmetric_difference(MultiPolygon(interiors))
 
 
-def polygon_to_mask(geom, coords, all_touched=False):
+def grid_window(bounds, coords, pad=1):
+    """return the (i0, i1, j0, j1) indices of the grid cells covering bounds
+
+    bounds: (minx, miny, maxx, maxy) as returned by shapely's `bounds`
+    coords: (lon, lat) defining the grid
+    pad: number of grid cells added on each side (clipped to the grid extent)
+    """
+    x, y = coords
+    ni, nj = y.size, x.size
+    transform = coords_to_gdal_transform(x, y)
+    if not len(bounds) or np.any(np.isnan(bounds)):  # empty geometry
+        return 0, 0, 0, 0
+    minx, miny, maxx, maxy = bounds
+    cols = (np.array([minx, maxx]) - transform.c) / transform.a
+    rows = (np.array([miny, maxy]) - transform.f) / transform.e
+    j0 = max(int(np.floor(cols.min())) - pad, 0)
+    j1 = min(int(np.ceil(cols.max())) + pad, nj)
+    i0 = max(int(np.floor(rows.min())) - pad, 0)
+    i1 = min(int(np.ceil(rows.max())) + pad, ni)
+    return i0, max(i1, i0), j0, max(j1, j0)
+
+
+def _window_mask(geom, coords, window, all_touched=False):
+    """rasterize geom on the grid cells defined by window = (i0, i1, j0, j1)
+    """
+    i0, i1, j0, j1 = window
+    shape = i1 - i0, j1 - j0
+    if geom.is_empty or 0 in shape:
+        return np.zeros(shape, dtype=bool)
+    geoms = getattr(geom, 'geoms', [geom])
+    transform = coords_to_gdal_transform(*coords) * rasterio.Affine.translation(j0, i0)
+    return rasterio.mask.geometry_mask(geoms, shape, transform, invert=True, all_touched=all_touched)
+
+
+def polygon_to_mask(geom, coords, all_touched=False, window=False):
     """return a numpy mask array which is True when it intersects with geometry
 
     all_touched : boolean, optional
         If True, all pixels touched by geometries will be burned in.  If
         false, only pixels whose center is within the polygon or that
         are selected by Bresenham's line algorithm will be burned in.
+    window : boolean, optional
+        If True, only rasterize the grid cells within the geometry bounds
+        (padded by one cell) and return `mask, (i0, j0)`, where (i0, j0) are
+        the row and column offsets of the sub-array in the full grid.
+    """
+    if window:
+        i0, i1, j0, j1 = grid_window(geom.bounds, coords)
+        return _window_mask(geom, coords, (i0, i1, j0, j1), all_touched=all_touched), (i0, j0)
+    shape = coords[1].size, coords[0].size
+    return _window_mask(geom, coords, (0, shape[0], 0, shape[1]), all_touched=all_touched)
+
+
+def polygons_to_labels(geoms, coords, all_touched=False, dtype=np.uint16):
+    """return an integer array where label k marks the grid cells of geoms[k-1] (0 where there is no geometry)
+
+    All geometries are burned in a single rasterization pass. Where they
+    overlap, the geometry that comes first in the list takes precedence.
     """
-    geoms = getattr(geom, 'geoms', [geom])
     shape = coords[1].size, coords[0].size
     transform = coords_to_gdal_transform(*coords)
-    return rasterio.mask.geometry_mask(geoms, shape, transform, invert=True, all_touched=all_touched)
+    shapes = [(geom, k) for k, geom in reversed(list(enumerate(geoms, 1))) if not geom.is_empty]
+    if not shapes:
+        return np.zeros(shape, dtype=dtype)
+    return rasterio.features.rasterize(shapes, out_shape=shape, transform=transform, fill=0, all_touched=all_touched, dtype=dtype)
+
+
+def block_reduce(array, factor, how='mean'):
+    """aggregate an array onto a coarser nested grid, where each coarse cell covers factor x factor cells
+
+    how: 'mean' (fractional masks) or 'any' (binary masks)
+    """
+    ni, nj = array.shape
+    blocks = array.reshape(ni//factor, factor, nj//factor, factor)
+    if how == 'mean':
+        return blocks.mean(axis=(1, 3))
+    elif how == 'any':
+        return blocks.any(axis=(1, 3))
+    raise ValueError(how)
 
 
-def polygon_to_fractional_mask(geom, coords, subgrid=None):
+def polygon_to_fractional_mask(geom, coords, subgrid=None, window=False, exact=False):
     """return a float-valued numpy array (values between 0 and 1) to indicate the fraction of grid pixel belonging to a country.
 
     geom: shapely geometry (Polygon or MultiPolygon)
     coords: (lon, lat) defining the grid
+    window: if True, return `mask, (i0, j0)` restricted to the geometry bounds (see polygon_to_mask)
+    exact: if True, compute the exact intersection area of marginal cells instead of supersampling them
 
-    The approach is to first delineate the all_touched mask, then process marginal cells at higher resolution to calculate fractions.
+    The approach is to first delineate the all_touched mask, then process marginal cells at higher resolution to calculate fractions
+    (see subcell_fractions), or exactly (see exact_fractions).
     """
+    lon, lat = coords
+    i0, i1, j0, j1 = grid_window(geom.bounds, coords)
+
     # apply recursively to subgeometry (useful for small islands)
     if hasattr(geom, 'geoms'):
-        geoms = geom.geoms
-        mask = 0.
-        for geom in geoms:
-            mask += polygon_to_fractional_mask(geom, coords, subgrid=subgrid)
-        return mask
+        mask = np.zeros((i1-i0, j1-j0))
+        for g in geom.geoms:
+            m, (i, j) = polygon_to_fractional_mask(g, coords, subgrid=subgrid, window=True, exact=exact)
+            mask[i-i0:i-i0+m.shape[0], j-j0:j-j0+m.shape[1]] += m
+
+    else:
+        mask = _fractional_window_mask(geom, coords, (i0, i1, j0, j1), subgrid=subgrid, exact=exact)
+
+    if window:
+        return mask, (i0, j0)
+
+    full = np.zeros((lat.size, lon.size))
+    full[i0:i1, j0:j1] = mask
+    return full
+
+
+def fractional_mask_band(geom, coords, i0, i1, subgrid=None, exact=False):
+    """return the fractional mask of geom for the grid rows i0:i1, as `mask, j0` restricted to the geometry bounds in longitude
+
+    Each part of the geometry is clipped to the band (plus one grid cell, so that the cells
+    of the band are not affected) before rasterization, and keeps the subgrid of the whole part.
+    Memory is therefore bounded by the band instead of the geometry window (see make_fractional_mask --memory-budget).
+
+    Fractions match polygon_to_fractional_mask, except where a sub-cell center lies on a polygon edge:
+    clipping recomputes the vertices, and the inside test of that point may flip, i.e. a difference of
+    one sub-cell (0.01 with the default 10x10 subgrid) in a supersampled grid cell. Exact fractions only
+    differ by float rounding.
+    """
+    lon, lat = coords
+    res = lon[1]-lon[0]
+    _, _, j0, j1 = grid_window(geom.bounds, coords)
+    mask = np.zeros((i1-i0, j1-j0))
+    for part in getattr(geom, 'geoms', [geom]):
+        pi0, pi1, _, _ = grid_window(part.bounds, coords)
+        if pi1 <= i0 or pi0 >= i1:
+            continue
+        sg = subgrid or _default_subgrid(part, res)
+        xmin, _, xmax, _ = part.bounds
+        clipped = shapely.clip_by_rect(part, xmin-res, lat[i1-1]-res*1.5, xmax+res, lat[i0]+res*1.5)
+        for piece in shapely.get_parts(clipped):
+            if shapely.get_type_id(piece) != 3:  # lines or points on the clipping edge
+                continue
+            a, b, c, d = grid_window(piece.bounds, coords)
+            a, b = max(a, i0), min(b, i1)
+            if a >= b:
+                continue
+            m = _fractional_window_mask(piece, coords, (a, b, c, d), subgrid=sg, exact=exact)
+            mask[a-i0:b-i0, c-j0:d-j0] += m
+    return mask, j0
+
+
+def encode_fractional_mask(mask):
+    """return a compact encoding of a fractional mask: (interior, index, fractions)
 
+    interior: bit-packed (np.packbits) flags of the cells equal to 1
+    index: flat indices of the other non-zero (marginal) cells
+    fractions: their values, as float32
+    """
+    flat = mask.ravel()
+    index = np.flatnonzero((flat != 0) & (flat != 1))
+    return np.packbits(flat == 1), index.astype(np.int64), flat[index].astype(np.float32)
+
+
+def decode_fractional_mask(encoded, shape, dtype=np.float32):
+    """inverse of encode_fractional_mask
+    """
+    interior, index, fractions = encoded
+    size = int(np.prod(shape))
+    flat = np.unpackbits(interior, count=size).astype(dtype)
+    flat[index] = fractions
+    return flat.reshape(shape)
+
+
+def fractional_mask_error(geom, coords, subgrid=None):
+    """return the max error of the supersampled fractions (exact=False) compared to exact fractions (exact=True)
+    """
+    if hasattr(geom, 'geoms'):
+        return max([fractional_mask_error(g, coords, subgrid=subgrid) for g in geom.geoms], default=0.)
     lon, lat = coords
     res = lon[1]-lon[0]
+    i0, i1, j0, j1 = window = grid_window(geom.bounds, coords)
+    _, ii, jj = _interior_and_margin(geom, coords, window)
+    if ii.size == 0:
+        return 0.
+    x, y = lon[j0+jj], lat[i0+ii]
+    approx = subcell_fractions(geom, x, y, res, subgrid or _default_subgrid(geom, res))
+    return np.abs(approx - exact_fractions(geom, x, y, res)).max()
+
+
+def _default_subgrid(geom, res):
     # for tiny territory we want sub-divide the grid much more
-    if subgrid is None:
-        ratio = res/geom.area**.5
-        subgrid = int(min(max(10, ratio*10), 100))
-    large = polygon_to_mask(geom, (lon, lat), all_touched=True)
+    ratio = res/geom.area**.5
+    return int(min(max(10, ratio*10), 100))
+
+
+def _interior_and_margin(geom, coords, window):
+    """return the interior mask and the (ii, jj) indices of marginal cells within window
+    """
+    res = coords[0][1]-coords[0][0]
+    large = _window_mask(geom, coords, window, all_touched=True)
     test = geom.buffer(-res*1.4142) # diagonal res*squrt(2), for more precise marginal calculation
     if test.area > 0:
-        interior = polygon_to_mask(test, (lon, lat), all_touched=False)
+        interior = _window_mask(test, coords, window, all_touched=False)
     else:
         interior = np.zeros_like(large)
     margin = large & ~interior
-    mask = np.zeros_like(large, dtype=float)
-    mask[interior] = 1
     ii, jj = np.where(margin)
-    for i, j in zip(ii, jj):
-        lo, la = lon[j], lat[i]
-        lon2 = np.linspace(lo-res/2, lo+res/2, subgrid)
-        lat2 = np.linspace(la-res/2, la+res/2, subgrid)
-        mask2 = polygon_to_mask(geom, (lon2, lat2), all_touched=False)
-        fraction = mask2.sum()/subgrid**2
-        mask[i, j] = fraction
+    return interior, ii, jj
+
+
+def _fractional_window_mask(geom, coords, window, subgrid=None, exact=False):
+    lon, lat = coords
+    i0, i1, j0, j1 = window
+    res = lon[1]-lon[0]
+    interior, ii, jj = _interior_and_margin(geom, coords, window)
+    mask = np.zeros(interior.shape, dtype=float)
+    mask[interior] = 1
+    if exact:
+        mask[ii, jj] = exact_fractions(geom, lon[j0+jj], lat[i0+ii], res)
+    else:
+        mask[ii, jj] = subcell_fractions(geom, lon[j0+jj], lat[i0+ii], res, subgrid or _default_subgrid(geom, res))
     return mask
+
+
+def exact_fractions(geom, x, y, res):
+    """return the exact fraction of each grid cell (centered on x, y) covered by geom
+
+    The cells are built as an array of shapely boxes and intersected with the
+    prepared geometry in one vectorized call.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    cells = shapely.box(x-res/2, y-res/2, x+res/2, y+res/2)
+    shapely.prepare(geom)
+    return np.clip(shapely.area(shapely.intersection(cells, geom)) / res**2, 0, 1)
+
+
+def subcell_fractions(geom, x, y, res, subgrid, max_points=2**22):
+    """return the fraction of each grid cell (centered on x, y) covered by geom
+
+    Each cell is divided into subgrid x subgrid sub-cells whose centers are
+    tested all at once with shapely's vectorized `contains_xy`, and the result
+    is reduced back to one fraction per cell with a block sum. Cells are
+    processed in batches of at most `max_points` sub-cell centers.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    offsets = (np.arange(subgrid) + 0.5) * res / subgrid - res / 2
+    shapely.prepare(geom)
+    fractions = np.empty(x.size)
+    batch = max(max_points // subgrid**2, 1)
+    for k in range(0, x.size, batch):
+        xx = x[k:k+batch, None, None] + offsets[None, None, :]
+        yy = y[k:k+batch, None, None] + offsets[None, :, None]
+        xx, yy = np.broadcast_arrays(xx, yy)
+        inside = shapely.contains_xy(geom, xx, yy)
+        fractions[k:k+batch] = inside.reshape(inside.shape[0], -1).sum(axis=1) / subgrid**2
+    return fractions
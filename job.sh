@@ -10,11 +10,19 @@ source venv/bin/activate
 
 # sbatch --mem=8000 geojson_to_grid.py --grid 0.5deg --fractional-mask --version v2.6
 # sbatch --mem=64000 geojson_to_grid.py --grid 5arcmin --fractional-mask --version v2.6
+#sbatch --mem=9000 --cpus-per-task=8 geojson_to_grid.py --grid 30arcsec --fractional-mask --memory-budget 8000 --jobs 8 --version v2.7
 
 #sbatch --mem=64000 geojson_to_grid.py --grid 30arcsec --binary-exclusive-mask --version v2.7
 sbatch --mem=64000 geojson_to_grid.py --grid 5arcmin --binary-exclusive-mask --version v2.7
-#sbatch --mem=64000 geojson_to_grid.py --grid 0.5deg --binary-exclusive-mask --version v2.7
+#sbatch --mem=64000 geojson_to_grid.py --grid 0.5deg --binary-exclusive-mask --force-exclusivity --label-mask --version v2.7  # label raster for country_data.lookup
 
 # and later:
 # mv countrymasks_fractional_0.5deg.nc countrymasks_fractional.nc
 # mv countrymasks_0.5deg.nc countrymasks.nc
+
+# sharded build as a SLURM array job (one shard per task), then merge the shards:
+#sbatch --mem=8000 --array=0-15 --wrap='venv/bin/python geojson_to_grid.py --grid 30arcsec --binary-mask --version v2.7 --shard ${SLURM_ARRAY_TASK_ID}/16'
+#sbatch --mem=16000 --dependency=afterok:<array job id> geojson_to_grid.py merge countrymasks_30arcsec_shard*of16.nc
+
+# rasterize once at 5arcmin, and derive the 0.5deg masks by block aggregation:
+#sbatch --mem=64000 geojson_to_grid.py --grid 5arcmin --binary-mask --fractional-mask --pyramid --version v2.7
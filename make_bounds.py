@@ -0,0 +1,205 @@
+#!venv/bin/python
+"""Regenerate country_data/XXX/bounds.json from the country masks
+
+    python make_bounds.py countrymasks.nc  # bounds.json, on the 0.5 degree grid
+    python make_bounds.py countrymasks_5arcmin.nc  # bounds_5arcmin.json
+
+country_data.country_window reads the bounds file of the grid, if present (bounds.json otherwise).
+
+The window of each region is taken from the label raster with scipy.ndimage.find_objects
+(see geojson_to_grid.py --label-mask), and from a scan of the mask variables in bands of
+grid rows for the other regions (groups, world, or files without labels). The label raster
+is exclusive: use --scan for windows that cover the inclusive masks (all_touched=True) too.
+"""
+import os
+import sys
+import json
+import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import netCDF4 as nc
+from scipy.ndimage import find_objects
+from geomstore import GeometryStore
+from country_data import BOUNDS_FILES
+
+
+def _band_step(v):
+    chunking = v.chunking()
+    return v.shape[0] if chunking == 'contiguous' else chunking[0]
+
+
+def _extents_from_labels(ds):
+    """return {code: (i0, i1, cols)} for the countries of the label raster, with find_objects
+
+    cols is the boolean profile of the occupied longitudes, only calculated exactly for
+    regions that span the whole grid width (candidates for the antimeridian split).
+    """
+    labels = ds['labels'][:].filled(0)
+    codes = list(ds['label_code'][:])
+    nj = labels.shape[1]
+    extents = {}
+    for k, sl in enumerate(find_objects(labels, max_label=len(codes)-1), 1):
+        if sl is None:
+            continue
+        rows, cols = sl
+        if cols.stop - cols.start == nj:
+            profile = np.any(labels[rows] == k, axis=0)
+        else:
+            profile = np.zeros(nj, dtype=bool)
+            profile[cols] = True
+        extents[codes[k]] = rows.start, rows.stop, profile
+    return extents
+
+
+def _extent_from_scan(v):
+    """return (i0, i1, cols) of the non-zero grid cells of a (lat, lon) variable, or None if empty
+    """
+    ni, nj = v.shape
+    step = _band_step(v)
+    rows = np.zeros(ni, dtype=bool)
+    cols = np.zeros(nj, dtype=bool)
+    for k in range(0, ni, step):
+        mask = v[k:k+step].filled(0) != 0
+        rows[k:k+step] = mask.any(axis=1)
+        cols |= mask.any(axis=0)
+    ii = np.flatnonzero(rows)
+    if ii.size == 0:
+        return None
+    return ii[0], ii[-1]+1, cols
+
+
+def region_extents(ds, scan=False):
+    """return {code: (i0, i1, cols)} for every region of the mask file: rows i0:i1 and the boolean
+    profile of occupied longitudes
+    """
+    extents = _extents_from_labels(ds) if 'labels' in ds.variables and not scan else {}
+    for m in ds.variables:
+        if not m.startswith('m_') or m[2:] in extents:
+            continue
+        extent = _extent_from_scan(ds[m])
+        if extent is None:
+            print(m[2:], "is empty, skip")
+            continue
+        extents[m[2:]] = extent
+    return extents
+
+
+def bounds_record(code, i0, i1, cols, lat, lon):
+    """return the content of bounds.json for a region
+
+    The window along longitudes leaves out the largest gap between occupied longitudes. When that
+    gap is not across the antimeridian, the region is `splitted`: bounds are then in the 0 to 360
+    range, and indices shifted by half the grid width accordingly (as in the existing files).
+    """
+    nj = lon.size
+    res = abs(lon[1] - lon[0])
+    occupied = np.flatnonzero(cols)
+    gaps = np.diff(np.concatenate([occupied, [occupied[0] + nj]]))  # gap after each occupied longitude
+    k = np.argmax(gaps)
+    splitted = bool(k < occupied.size - 1 and gaps[k] > gaps[-1])
+    if splitted:
+        j0, width = occupied[k+1], occupied[k] + nj + 1 - occupied[k+1]
+        left = (lon[j0] - res/2) % 360
+        jleft = (j0 - nj//2) % nj
+    else:
+        j0, width = occupied[0], occupied[-1] + 1 - occupied[0]
+        left = lon[j0] - res/2
+        jleft = j0
+    return {
+        "code": code,
+        "bounds": {
+            "left": round(float(left), 6),
+            "right": round(float(left + width*res), 6),
+            "bottom": round(float(lat[i1-1] - res/2), 6),
+            "top": round(float(lat[i0] + res/2), 6),
+        },
+        "indices": {"left": int(jleft), "right": int(jleft + width - 1), "bottom": int(i1-1), "top": int(i0)},
+        "splitted": splitted,
+    }
+
+
+def check_geometry(record, geom, res):
+    """return a list of inconsistencies between a bounds record and the geometry of the region:
+    a polygon beyond the window, or a window beyond the geometry, by more than one grid cell
+    """
+    b = record['bounds']
+    width = b['right'] - b['left']
+    tol = res + 1e-6
+    problems = []
+    for part in getattr(geom, 'geoms', [geom]):
+        xmin, ymin, xmax, ymax = part.bounds
+        x = (xmin - b['left']) % 360  # part position within the window
+        if x > 360 - tol:
+            x -= 360
+        if x < -tol or x + (xmax - xmin) > width + tol or ymin < b['bottom'] - tol or ymax > b['top'] + tol:
+            problems.append(f"polygon {tuple(round(v, 3) for v in part.bounds)} beyond the window")
+    xmin, ymin, xmax, ymax = geom.bounds
+    if b['bottom'] < ymin - tol or b['top'] > ymax + tol:
+        problems.append(f"window latitudes {b['bottom']}, {b['top']} beyond the geometry {ymin:.3f}, {ymax:.3f}")
+    if not record['splitted'] and (b['left'] < xmin - tol or b['right'] > xmax + tol):
+        problems.append(f"window longitudes {b['left']}, {b['right']} beyond the geometry {xmin:.3f}, {xmax:.3f}")
+    return problems
+
+
+def write_json_atomic(path, record):
+    """write record to path through a temporary file in the same folder, unless unchanged.
+    Return True if the file was written.
+    """
+    content = json.dumps(record)
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mask_file')
+    parser.add_argument('--scan', action='store_true', help="scan every mask variable, even if the file has a label raster")
+    parser.add_argument('--geojson', default='countrymasks.geojson', help="geometries to check the windows against (default: %(default)s)")
+    parser.add_argument('--no-check', action='store_true', help="do not check the windows against the geometries")
+    parser.add_argument('--strict', action='store_true', help="exit with an error (and write nothing) if any window is inconsistent with its geometry")
+    parser.add_argument('--folder', default='country_data', help="(default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=8, help="number of threads to write the files (default: %(default)s)")
+    o = parser.parse_args()
+
+    with nc.Dataset(o.mask_file) as ds:
+        lat, lon = ds['lat'][:], ds['lon'][:]
+        if lon.size not in BOUNDS_FILES:
+            parser.error(f"{o.mask_file}: unknown grid with {lon.size} longitudes")
+        extents = region_extents(ds, scan=o.scan)
+
+    res = abs(lon[1] - lon[0])
+    records = {code: bounds_record(code, *extent, lat, lon) for code, extent in sorted(extents.items())}
+    print(len(records), "regions,", sum(r['splitted'] for r in records.values()), "across the antimeridian")
+
+    if not o.no_check:
+        store = GeometryStore.load(o.geojson)
+        n = 0
+        for code, record in records.items():
+            if code not in store:
+                continue
+            for problem in check_geometry(record, store.geometry(code), res):
+                print(f"{code}: {problem}")
+                n += 1
+        print(n, "inconsistencies with", o.geojson)
+        if n and o.strict:
+            sys.exit(1)
+
+    file_name = BOUNDS_FILES[lon.size]
+    paths = [os.path.join(o.folder, code, file_name) for code in records]
+    with ThreadPoolExecutor(o.jobs) as pool:
+        written = list(pool.map(write_json_atomic, paths, records.values()))
+    print(f"{sum(written)} {file_name} files written, {len(written)-sum(written)} unchanged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""On-disk cache of rasterized country masks, used by geojson_to_grid.py
+
+Each entry is keyed on the content hash of the geometry (WKB), the grid resolution,
+the kind of mask and ALGORITHM_VERSION, and stores the windowed mask with its offsets.
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+# increase whenever the rasterization in geomtools changes the results
+ALGORITHM_VERSION = 1
+
+
+class MaskCache:
+    """Least-recently-used cache of windowed masks in a directory
+
+    path: cache directory
+    max_size: total size of the cache in bytes, beyond which the least recently used entries are removed
+    """
+    def __init__(self, path='.mask_cache', max_size=2e9):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, wkb, res, fractional, kwargs):
+        h = hashlib.sha256(wkb)
+        h.update(repr((res, fractional, sorted(kwargs.items()), ALGORITHM_VERSION)).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key+'.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        """return (mask, (i0, j0), error) or None if not in cache
+        """
+        fname = self._file(key)
+        try:
+            with np.load(fname) as npz:
+                mask, offsets, error = npz['mask'], tuple(int(i) for i in npz['offsets']), npz['error']
+        except FileNotFoundError:
+            return None
+        os.utime(fname)  # mark as recently used
+        return mask, offsets, (None if np.isnan(error) else float(error))
+
+    def put(self, key, mask, offsets, error=None):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, mask=mask, offsets=np.array(offsets), error=np.nan if error is None else error)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
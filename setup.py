@@ -9,9 +9,9 @@ setup(name='isipedia-countries',
       author_email='mahe.perrette@pik-potsdam.de',
       description='Country data for isipedia',
       url='https://github.com/ISI-MIP/isipedia-countries',
-      py_modules = ['country_data'],
+      py_modules = ['country_data', 'geomstore'],
       data_files = [
-          ('country_data', ['countrymasks.tif', 'countrymasks.nc', 'countrymasks_fractional.nc', 'Estimated_population_2005.nc', 'gridarea.nc'])
+          ('country_data', ['countrymasks.tif', 'countrymasks.nc', 'countrymasks_fractional.nc', 'countrymasks_binary_exclusive_0.5deg.nc', 'Estimated_population_2005.nc', 'gridarea.nc'])
       ] + [ (countrydir, glob.glob(f'{countrydir}/*') ) 
            for countrydir in glob.glob('country_data/*') if os.path.isdir(countrydir) ],
       install_requires = open('requirements.txt').read(),